@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+'''
+Compare queries which check units.active with ones that also join the
+meta:active feature of every unit, as queries did before schema
+version 1.3.
+
+The database is analyzed first, since without statistics SQLite picks
+a poor join order for the 5-unit query either way.
+'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import argument_parser, synthetic_corpus, best_of
+from rebabel_format.db import RBBLFile
+from rebabel_format.query import Query
+
+UPOS = ['DET', 'NOUN', 'VERB', 'ADJ']
+
+def build(db, size, meta_active):
+    '''A sentence containing `size - 1` words with different parts of
+    speech.'''
+    Q = Query(db)
+    S = Q.unit('sentence', 'S')
+    units = [S]
+    for i in range(size - 1):
+        W = Q.unit('word', f'W{i}')
+        Q.add(W.parent(S))
+        Q.add(W['UD:upos'] == UPOS[i % len(UPOS)])
+        units.append(W)
+    if meta_active:
+        for u in units:
+            Q.add(u['meta:active'] == True)
+    return Q
+
+def main():
+    args = argument_parser(__doc__).parse_args()
+    with synthetic_corpus(args) as path:
+        RBBLFile(path).analyze()
+        for size in [3, 5]:
+            times = []
+            for meta_active in [True, False]:
+                def query():
+                    db = RBBLFile(path)
+                    return len(list(build(db, size, meta_active).search()))
+                times.append(best_of(query))
+            b, a = times
+            print(f'{size} units: {b:.3f}s with meta:active, {a:.3f}s with units.active ({b/a:.1f}x)')
+
+if __name__ == '__main__':
+    main()
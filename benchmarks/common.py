@@ -0,0 +1,74 @@
+'''
+Shared helpers for the benchmark scripts in this directory.
+
+These are not run as part of the test suite. Each script can be invoked
+directly, e.g. `python3 benchmarks/indexes.py --sentences 20000`.
+'''
+
+import argparse
+import contextlib
+import os
+import random
+import tempfile
+import time
+
+from rebabel_format import load_processes, load_readers, load_writers, run_command
+
+load_processes(False)
+load_readers(False)
+load_writers(False)
+
+LEMMAS = ['the', 'a', 'man', 'woman', 'dog', 'cat', 'see', 'run', 'sing',
+          'snore', 'house', 'tree', 'big', 'small', 'quickly', 'and']
+UPOS = ['DET', 'DET', 'NOUN', 'NOUN', 'NOUN', 'NOUN', 'VERB', 'VERB', 'VERB',
+        'VERB', 'NOUN', 'NOUN', 'ADJ', 'ADJ', 'ADV', 'CCONJ']
+
+def argument_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--sentences', type=int, default=5000,
+                        help='number of synthetic sentences to generate')
+    parser.add_argument('--words', type=int, default=12,
+                        help='number of words per sentence')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser
+
+def write_conllu(pth, sentences, words, seed=0):
+    '''Write a random CoNLL-U file with `sentences` sentences
+    of `words` words each.'''
+    rng = random.Random(seed)
+    with open(pth, 'w') as fout:
+        for s in range(1, sentences+1):
+            fout.write(f'# sent_id = {s}\n')
+            for w in range(1, words+1):
+                i = rng.randrange(len(LEMMAS))
+                head = 0 if w == 1 else rng.randrange(1, w)
+                num = rng.choice(['Sing', 'Plur'])
+                fout.write(f'{w}\t{LEMMAS[i]}\t{LEMMAS[i]}\t{UPOS[i]}\t_\tNumber={num}\t{head}\t_\t_\t_\n')
+            fout.write('\n')
+
+@contextlib.contextmanager
+def synthetic_corpus(args):
+    '''Yield the path of a temporary database containing a synthetic
+    CoNLL-U import.'''
+    with tempfile.TemporaryDirectory() as tmp:
+        conllu = os.path.join(tmp, 'corpus.conllu')
+        db = os.path.join(tmp, 'corpus.db')
+        write_conllu(conllu, args.sentences, args.words, args.seed)
+        with timer(f'import {args.sentences*args.words} words'):
+            run_command('import', {}, mode='conllu', infiles=[conllu], db=db)
+        yield db
+
+@contextlib.contextmanager
+def timer(label):
+    start = time.perf_counter()
+    yield
+    print(f'{label}: {time.perf_counter()-start:.3f}s')
+
+def best_of(fn, repeat=3):
+    '''Return the fastest of `repeat` runs of `fn()` in seconds.'''
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
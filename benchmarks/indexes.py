@@ -0,0 +1,52 @@
+#!/usr/bin/env python3
+'''
+Compare query and export times with and without the secondary indexes
+added by schema version 1.1.
+'''
+
+import io
+import os
+import shutil
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import argument_parser, synthetic_corpus, best_of
+from rebabel_format import run_command
+from rebabel_format.db import RBBLFile
+from rebabel_format.query import search
+
+INDEXES = ['features_feature_value', 'relations_child', 'relations_parent',
+           'units_type']
+
+QUERY = {
+    'S': {'type': 'sentence'},
+    'N': {'type': 'word', 'parent': 'S',
+          'features': [{'feature': 'UD:lemma', 'value': 'woman'}]},
+}
+
+def measure(db_path):
+    def query():
+        db = RBBLFile(db_path)
+        return len(list(search(db, QUERY)))
+    def export():
+        out = db_path + '.conllu'
+        run_command('export', {}, mode='conllu', db=db_path, outfile=out)
+    return best_of(query), best_of(export, repeat=1)
+
+def main():
+    args = argument_parser(__doc__).parse_args()
+    with synthetic_corpus(args) as indexed:
+        bare = indexed + '.bare'
+        shutil.copy(indexed, bare)
+        db = RBBLFile(bare)
+        for name in INDEXES:
+            db.cur.execute(f'DROP INDEX {name}')
+        db.con.commit()
+        before = measure(bare)
+        after = measure(indexed)
+        for label, b, a in zip(['query', 'export'], before, after):
+            print(f'{label}: {b:.3f}s without indexes, {a:.3f}s with indexes ({b/a:.1f}x)')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+'''
+Compare the speed of importing CoNLL-U when `Reader.finish_block` creates
+units one at a time with `create_unit`, as it did originally, and when
+it creates them all at once with `create_units_many`.
+'''
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import argument_parser, write_conllu, best_of
+from rebabel_format import run_command
+from rebabel_format.db import RBBLFile
+
+def create_units_singly(self, unittypes, user=None):
+    return [self.create_unit(unittype, user=user) for unittype in unittypes]
+
+def import_time(conllu, db):
+    def run():
+        for pth in [db, db + '-wal', db + '-shm']:
+            if os.path.exists(pth):
+                os.remove(pth)
+        run_command('import', {}, mode='conllu', infiles=[conllu], db=db)
+    return best_of(run)
+
+def main():
+    args = argument_parser(__doc__).parse_args()
+    with tempfile.TemporaryDirectory() as tmp:
+        conllu = os.path.join(tmp, 'corpus.conllu')
+        db = os.path.join(tmp, 'corpus.db')
+        write_conllu(conllu, args.sentences, args.words, args.seed)
+        batched = RBBLFile.create_units_many
+        try:
+            RBBLFile.create_units_many = create_units_singly
+            before = import_time(conllu, db)
+        finally:
+            RBBLFile.create_units_many = batched
+        after = import_time(conllu, db)
+        units = RBBLFile(db).first('SELECT COUNT(*) FROM units')[0]
+        print(f'{units} units: {units/before:.0f} units/s with create_unit, {units/after:.0f} units/s with create_units_many ({before/after:.1f}x)')
+
+if __name__ == '__main__':
+    main()
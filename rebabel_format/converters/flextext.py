@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from rebabel_format.reader import XMLReader
+from rebabel_format.reader import StreamingXMLReader
 from rebabel_format.writer import Writer
 from rebabel_format.parameters import Parameter
 
@@ -12,7 +12,7 @@ ANALYSIS_STATUSES = [
 ]
 
 # TODO: should we record <document version= exportSource= exportTarget=>?
-class FlextextReader(XMLReader):
+class FlextextReader(StreamingXMLReader):
     '''
     The imported unit types will be `interlinear-text`, `paragraph`, `phrase`,
     `word`, and `morph`, corresponding to the XML nodes of the same names.
@@ -32,14 +32,34 @@ class FlextextReader(XMLReader):
     long_name = 'SIL Fieldworks Language Explorer XML glossed text'
     format_specification = 'https://github.com/sillsdev/FieldWorks/blob/release/9.1/DistFiles/Language%20Explorer/Export%20Templates/Interlinear/FlexInterlinear.xsd'
 
+    known = ['interlinear-text', 'paragraph', 'phrase', 'word', 'morph',
+             'scrMilestone', 'language', 'media']
+
+    # the file is written one paragraph at a time
+    block_tags = ['interlinear-text', 'paragraph']
+
     def read_file(self, fin):
-        self.iter_nodes(fin, ())
-        self.finish_block()
+        # [name of the enclosing unit, kind of element, number of children]
+        self.open_nodes = []
+        super().read_file(fin)
+        if self.id_seq:
+            self.finish_block()
 
-    def iter_nodes(self, node, parent=None, idx=0):
-        known = ['interlinear-text', 'paragraph', 'phrase', 'word', 'morph',
-                 'scrMilestone', 'language', 'media']
-        if node.tag in known:
+    def start_element(self, node):
+        if not self.open_nodes:
+            parent, idx = (), 0
+        else:
+            entry = self.open_nodes[-1]
+            parent = entry[0]
+            if entry[1] in ['item', 'skip']:
+                self.open_nodes.append([parent, 'skip', 0])
+                return
+            if entry[1] == 'unit' and node.tag == 'item':
+                self.open_nodes.append([parent, 'item', 0])
+                return
+            entry[2] += 1
+            idx = entry[2]
+        if node.tag in self.known:
             name = parent + (idx,)
             self.set_type(name, node.tag)
             if parent:
@@ -51,27 +71,27 @@ class FlextextReader(XMLReader):
                     typ = 'int'
                     val = int(val)
                 self.set_feature(name, 'FlexText:'+feat, typ, val)
-            chidx = 0
-            for ch in node:
-                if ch.tag == 'item':
-                    feat = ':'.join(['FlexText', ch.attrib.get('lang', 'None'),
-                                     ch.attrib.get('type', 'None')])
-                    val = ch.text or ''
-                    confidence = None
-                    if 'analysisStatus' in ch.attrib:
-                        confidence = dict(ANANLYSIS_STATUSES).get(
-                            ch.attrib['analysisStatus'], 0)
-                    self.set_feature(name, feat, 'str', val,
-                                     confidence=confidence)
-                else:
-                    chidx += 1
-                    self.iter_nodes(ch, parent=name, idx=chidx)
+            self.open_nodes.append([name, 'unit', 0])
         else:
             if parent:
                 for feat, val in node.attrib.items():
                     self.set_feature(parent, 'FlexText:'+feat, 'str', val)
-            for i, ch in enumerate(node, 1):
-                self.iter_nodes(ch, parent=parent, idx=i)
+            self.open_nodes.append([parent, 'other', 0])
+
+    def read_element(self, node):
+        name, kind, _ = self.open_nodes.pop()
+        if kind == 'item':
+            feat = ':'.join(['FlexText', node.attrib.get('lang', 'None'),
+                             node.attrib.get('type', 'None')])
+            val = node.text or ''
+            confidence = None
+            if 'analysisStatus' in node.attrib:
+                confidence = dict(ANALYSIS_STATUSES).get(
+                    node.attrib['analysisStatus'], 0)
+            self.set_feature(name, feat, 'str', val, confidence=confidence)
+        elif kind == 'unit' and node.tag in self.block_tags:
+            self.finish_block(
+                keep_uids=[entry[0] for entry in self.open_nodes])
 
 # TODO: export scrMilestone, language, media
 # TODO: confidence → analysisStatus
@@ -1,6 +1,6 @@
-from rebabel_format.reader import XMLReader
+from rebabel_format.reader import StreamingXMLReader
 
-class MaculaNodeReader(XMLReader):
+class MaculaNodeReader(StreamingXMLReader):
     '''
     XML nodes will be imported according to the following mappings:
 
@@ -20,39 +20,40 @@ class MaculaNodeReader(XMLReader):
     identifier = 'macula-node'
     format_specification = 'https://github.com/Clear-Bible/macula-hebrew/blob/main/doc/MACULA%20Hebrew%20Treebank%20for%20Open%20Scriptures%20Hebrew%20Bible.pdf'
 
-    def read_file(self, root):
-        node_ids = ['nodeId', '{http://www.w3.org/XML/1998/namespace}id']
-
-        def get_node_id(node):
-            for key in node_ids:
-                if key in node.attrib:
-                    return node.attrib[key]
-
-        for sentence in root.iter('Sentence'):
-            verse = sentence.attrib['verse']
-            self.set_type(verse, 'sentence')
-            for child in sentence.iter():
-                nid = get_node_id(child)
-                if nid is None:
-                    continue
-                if child.tag == 'm':
-                    self.set_type(nid, 'morpheme')
-                elif child.tag == 'Node':
-                    self.set_type(nid, 'syntax-node')
-
-                self.set_parent(nid, verse)
-
-                for grandchild in child:
-                    gid = get_node_id(grandchild)
-                    if gid:
-                        self.add_relation(gid, nid)
-
-                if child.text and not child.text.isspace():
-                    self.set_feature(nid, 'macula:form', 'str', child.text)
-
-                for key, value in child.attrib.items():
-                    if key in node_ids:
-                        key = 'id'
-                    self.set_feature(nid, 'macula:'+key, 'str', value)
+    element_tags = ['Sentence']
+
+    node_ids = ['nodeId', '{http://www.w3.org/XML/1998/namespace}id']
+
+    def get_node_id(self, node):
+        for key in self.node_ids:
+            if key in node.attrib:
+                return node.attrib[key]
+
+    def read_element(self, sentence):
+        verse = sentence.attrib['verse']
+        self.set_type(verse, 'sentence')
+        for child in sentence.iter():
+            nid = self.get_node_id(child)
+            if nid is None:
+                continue
+            if child.tag == 'm':
+                self.set_type(nid, 'morpheme')
+            elif child.tag == 'Node':
+                self.set_type(nid, 'syntax-node')
+
+            self.set_parent(nid, verse)
+
+            for grandchild in child:
+                gid = self.get_node_id(grandchild)
+                if gid:
+                    self.add_relation(gid, nid)
+
+            if child.text and not child.text.isspace():
+                self.set_feature(nid, 'macula:form', 'str', child.text)
+
+            for key, value in child.attrib.items():
+                if key in self.node_ids:
+                    key = 'id'
+                self.set_feature(nid, 'macula:'+key, 'str', value)
 
         self.finish_block()
@@ -5,7 +5,10 @@ import datetime
 import os.path
 import itertools
 import contextlib
-from collections import defaultdict
+import functools
+import hashlib
+import json
+from collections import defaultdict, OrderedDict
 from dataclasses import dataclass
 from typing import Any
 import re
@@ -18,12 +21,178 @@ def load_schema():
         from importlib_resources import files
     return files('rebabel_format').joinpath('schema.sql').read_text()
 
+# Each entry is the (major, minor) version that a database will be at
+# after running the accompanying script. `RBBLFile` applies any entries
+# newer than the version recorded in the `metadata` table when a file
+# is opened, so new entries must only ever be appended.
+MIGRATIONS = [
+    ((1, 1), '''
+CREATE INDEX IF NOT EXISTS features_feature_value
+       ON features(feature, value, unit);
+CREATE INDEX IF NOT EXISTS relations_child
+       ON relations(child, isprimary, active);
+CREATE INDEX IF NOT EXISTS relations_parent
+       ON relations(parent, child_type, active, isprimary);
+CREATE INDEX IF NOT EXISTS units_type
+       ON units(type, active);
+'''),
+    ((1, 2), '''
+-- estimates for query planning, refreshed by `RBBLFile.analyze()`
+CREATE TABLE IF NOT EXISTS unit_type_stats(
+       type TEXT PRIMARY KEY,
+       count INTEGER
+);
+CREATE TABLE IF NOT EXISTS tier_stats(
+       tier INTEGER PRIMARY KEY,
+       count INTEGER,
+       distinct_values INTEGER,
+       FOREIGN KEY(tier) REFERENCES tiers(id)
+);
+CREATE TABLE IF NOT EXISTS tier_common_values(
+       tier INTEGER,
+       value,
+       count INTEGER,
+       FOREIGN KEY(tier) REFERENCES tiers(id)
+);
+'''),
+    ((1, 3), '''
+-- queries check units.active rather than meta:active
+UPDATE units SET active = (
+       SELECT F.value FROM features F JOIN tiers T ON F.feature = T.id
+       WHERE F.unit = units.id AND T.name = 'meta:active'
+)
+WHERE EXISTS (
+       SELECT NULL FROM features F JOIN tiers T ON F.feature = T.id
+       WHERE F.unit = units.id AND T.name = 'meta:active'
+);
+'''),
+    ((1, 4), '''
+-- incremented whenever the contents of the database change
+ALTER TABLE metadata ADD COLUMN generation INTEGER DEFAULT 0;
+DROP TRIGGER IF EXISTS edit;
+CREATE TRIGGER edit BEFORE UPDATE ON features
+       BEGIN
+        INSERT INTO history VALUES
+               (OLD.unit, OLD.feature, OLD.value, OLD.user, OLD.confidence,
+               OLD.date, NEW.date);
+        UPDATE units SET modified = NEW.date WHERE id = NEW.unit;
+        UPDATE metadata SET generation = generation + 1;
+       END;
+DROP TRIGGER IF EXISTS del;
+CREATE TRIGGER del BEFORE DELETE ON features
+       BEGIN
+        INSERT INTO history VALUES
+               (OLD.unit, OLD.feature, OLD.value, OLD.user, OLD.confidence,
+               OLD.date, datetime('now'));
+        UPDATE units SET modified = datetime('now') WHERE id = OLD.unit;
+        UPDATE metadata SET generation = generation + 1;
+       END;
+-- see `RBBLFile.fetch_cached()`
+CREATE TABLE IF NOT EXISTS result_cache(
+       key TEXT PRIMARY KEY,
+       generation INTEGER,
+       result TEXT
+);
+'''),
+    ((1, 5), '''
+-- every (ancestor, descendant) pair in the primary hierarchy,
+-- maintained by `RBBLFile.update_ancestry()`
+CREATE TABLE IF NOT EXISTS ancestry(
+       ancestor INTEGER,
+       descendant INTEGER,
+       PRIMARY KEY(ancestor, descendant)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS ancestry_descendant
+       ON ancestry(descendant, ancestor);
+-- booleans are stored as the blobs '1' and '0'
+WITH RECURSIVE up(descendant, ancestor) AS (
+       SELECT child, parent FROM relations
+       WHERE isprimary = X'31' AND active = X'31'
+       UNION
+       SELECT up.descendant, R.parent FROM up JOIN relations R
+       ON R.child = up.ancestor
+       WHERE R.isprimary = X'31' AND R.active = X'31'
+)
+INSERT OR IGNORE INTO ancestry(ancestor, descendant)
+       SELECT ancestor, descendant FROM up;
+'''),
+]
+
+# Connection settings which can be selected with `RBBLFile.set_profile()`
+# or the `db_profile` parameter of any process.
+PROFILES = {
+    # SQLite defaults: rollback journal and an fsync on every commit
+    'safe': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'cache_size': -2000,
+        'mmap_size': 0,
+        'temp_store': 'DEFAULT',
+        'busy_timeout': 5000,
+    },
+    # allow readers to proceed while something else is writing
+    'read-mostly': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -65536,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 5000,
+    },
+    # larger caches for big transactions; in WAL mode, NORMAL only syncs
+    # at checkpoints, so a crash may lose the most recent transactions,
+    # but not corrupt the file (which OFF could do)
+    'bulk-import': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -262144,
+        'mmap_size': 268435456,
+        'temp_store': 'MEMORY',
+        'busy_timeout': 30000,
+    },
+}
+
 sql.register_adapter(datetime.datetime, lambda d: d.isoformat())
 sql.register_converter('datetime', lambda b: datetime.datetime.fromisoformat(b.decode()))
 
 sql.register_adapter(bool, lambda bl: b'1' if bl else b'0')
 sql.register_converter('bool', lambda b: False if b == b'0' else True)
 
+@functools.lru_cache(maxsize=256)
+def compile_pattern(pattern, ignore_case=False):
+    try:
+        return re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+    except re.error as e:
+        raise ValueError(f'Invalid regular expression {pattern!r}: {e}')
+
+def as_text(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', errors='replace')
+    return str(value)
+
+# SQL functions registered by `RBBLFile`, used by the query operators
+# `matches`, `imatches`, and `iequals`
+def sql_matches(value, pattern):
+    if value is None or pattern is None:
+        return None
+    return compile_pattern(pattern).search(as_text(value)) is not None
+
+def sql_imatches(value, pattern):
+    if value is None or pattern is None:
+        return None
+    return compile_pattern(pattern, True).search(as_text(value)) is not None
+
+def sql_casefold(value):
+    if value is None:
+        return None
+    return as_text(value).casefold()
+
+SQL_FUNCTIONS = [
+    ('rbbl_matches', 2, sql_matches),
+    ('rbbl_imatches', 2, sql_imatches),
+    ('rbbl_casefold', 1, sql_casefold),
+]
+
 @dataclass
 class WhereClause:
     variable: str
@@ -33,6 +202,11 @@ class WhereClause:
 
     like_escape = re.compile('([%_$])')
 
+    # Lists of integers or strings longer than this are passed to SQLite
+    # as a single JSON array rather than one parameter per item, since
+    # SQLite limits the number of parameters in a statement.
+    list_threshold = 500
+
     def single_clause(self, val):
         op_map = {
             'lt': '<',
@@ -60,6 +234,10 @@ class WhereClause:
 
         if self.operator == 'is':
             if isinstance(self.value, list):
+                if (len(self.value) > self.list_threshold and
+                    all(isinstance(v, (int, str)) and not isinstance(v, bool)
+                        for v in self.value)):
+                    return f'{self.variable} {neg}IN (SELECT value FROM json_each(?))', [json.dumps(self.value)]
                 qs = ', '.join(['?']*len(self.value))
                 return f'{self.variable} {neg}IN ({qs})', self.value
             else:
@@ -73,6 +251,131 @@ class WhereClause:
                 escaped_values.append(v)
             return f'{neg}({" OR ".join(clauses)})', escaped_values
 
+class TierCatalog:
+    '''An in-memory copy of the `tiers` table.
+
+    Lookups which aren't found are checked against the database (and
+    counted as misses) in case another connection has added them. Tiers
+    which still aren't found are remembered as missing until a tier is
+    added or `reload()` is called.'''
+
+    def __init__(self, con):
+        self.cur = con.cursor()
+        self.hits = 0
+        self.misses = 0
+        # incremented whenever a tier is added, so that anything derived
+        # from the catalog can tell whether it is out of date
+        self.generation = 0
+        self.reload()
+
+    def reload(self):
+        self.by_name = {} # (unittype, name) => (id, valuetype)
+        self.by_id = {} # id => (name, unittype, valuetype)
+        self.missing_names = set() # {(unittype, name), ...}
+        self.missing_ids = set()
+        self.cur.execute('SELECT id, name, unittype, valuetype FROM tiers')
+        for row in self.cur.fetchall():
+            self.add(*row)
+
+    def add(self, tid, name, unittype, valuetype):
+        self.generation += 1
+        self.by_name[(unittype, name)] = (tid, valuetype)
+        self.by_id[tid] = (name, unittype, valuetype)
+        self.missing_names.clear()
+        self.missing_ids.clear()
+
+    def get(self, unittype, name):
+        '''Return `(id, valuetype)` of the tier or `None`.'''
+        ret = self.by_name.get((unittype, name))
+        if ret is not None:
+            self.hits += 1
+            return ret
+        if (unittype, name) in self.missing_names:
+            self.hits += 1
+            return None
+        self.misses += 1
+        self.cur.execute(
+            'SELECT id, name, unittype, valuetype FROM tiers WHERE unittype = ? AND name = ? LIMIT 1',
+            (unittype, name))
+        row = self.cur.fetchone()
+        if row is None:
+            self.missing_names.add((unittype, name))
+            return None
+        self.add(*row)
+        return row[0], row[3]
+
+    def get_by_id(self, tid):
+        '''Return `(name, unittype, valuetype)` of the tier or `None`.'''
+        ret = self.by_id.get(tid)
+        if ret is not None:
+            self.hits += 1
+            return ret
+        if tid in self.missing_ids:
+            self.hits += 1
+            return None
+        self.misses += 1
+        self.cur.execute(
+            'SELECT id, name, unittype, valuetype FROM tiers WHERE id = ?',
+            (tid,))
+        row = self.cur.fetchone()
+        if row is None:
+            self.missing_ids.add(tid)
+            return None
+        self.add(*row)
+        return row[1:]
+
+class TierStats:
+    '''Row counts and most common values for each unit type and tier,
+    as of the last call to `RBBLFile.analyze()`.
+
+    These may be out of date and are only meant for query planning.'''
+
+    def __init__(self, con):
+        self.cur = con.cursor()
+        # incremented by reload(), like `TierCatalog.generation`
+        self.generation = 0
+        self.reload()
+
+    def reload(self):
+        self.generation += 1
+        self.tiers = {} # id => (count, distinct values)
+        self.common = defaultdict(dict) # id => {value => count}
+        self.cur.execute('SELECT type, count FROM unit_type_stats')
+        self.units = dict(self.cur.fetchall()) # type => count
+        self.cur.execute('SELECT tier, count, distinct_values FROM tier_stats')
+        for tier, count, distinct in self.cur.fetchall():
+            self.tiers[tier] = (count, distinct)
+        self.cur.execute('SELECT tier, value, count FROM tier_common_values')
+        for tier, value, count in self.cur.fetchall():
+            self.common[tier][value] = count
+
+    def __bool__(self):
+        return bool(self.units)
+
+    def count_units(self, unittypes):
+        '''Estimate the number of units of the given types.'''
+        return sum(self.units.get(t, 0) for t in utils.as_list(unittypes))
+
+    def count_tiers(self, tiers):
+        '''Estimate the number of features in the given tiers.'''
+        return sum(self.tiers.get(t, (0, 0))[0] for t in tiers)
+
+    def count_value(self, tiers, value):
+        '''Estimate the number of features in the given tiers which
+        have the value `value`.'''
+        if isinstance(value, bool):
+            value = b'1' if value else b'0'
+        total = 0
+        for tier in tiers:
+            count, distinct = self.tiers.get(tier, (0, 0))
+            common = self.common.get(tier, {})
+            if value in common:
+                total += common[value]
+            elif distinct > len(common):
+                # assume the remaining values are evenly distributed
+                total += (count - sum(common.values())) / (distinct - len(common))
+        return total
+
 class RBBLFile:
     @contextlib.contextmanager
     def transaction(self):
@@ -87,7 +390,8 @@ class RBBLFile:
             self.committing = com_was
             self.commit()
 
-    def __init__(self, pth, create=True):
+    def __init__(self, pth, create=True, profile=None,
+                 unit_type_cache_size=100000):
         self.path = pth
         if not os.path.exists(pth):
             if create:
@@ -99,8 +403,158 @@ class RBBLFile:
         else:
             self.con = sql.connect(pth, detect_types=sql.PARSE_DECLTYPES)
         self.cur = self.con.cursor()
+        self.register_functions()
         self.current_time = None
         self.committing = True
+        self.profile_name = None
+        self.migrate()
+        # see `commit()` and `change_generation()`
+        self.changes_seen = self.con.total_changes
+        self.result_cache = False
+        self.text_index = bool(self.first(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'features_fts'"))
+        self.catalog = TierCatalog(self.con)
+        self.stats = TierStats(self.con)
+        # normalized query => (generations, Query), see query.py
+        self.query_cache = OrderedDict()
+        # unit ID => unit type, least recently used first
+        self.unit_types = OrderedDict()
+        self.unit_type_cache_size = unit_type_cache_size
+        if profile is not None:
+            self.set_profile(profile)
+
+    def register_functions(self):
+        '''Make the functions in `SQL_FUNCTIONS` available to queries.
+        They are marked as deterministic where possible, so that SQLite
+        can factor them out of loops and use them in indexes.'''
+        self.deterministic = True
+        for name, nargs, fn in SQL_FUNCTIONS:
+            try:
+                self.con.create_function(name, nargs, fn, deterministic=True)
+            except (TypeError, sql.NotSupportedError):
+                # Python < 3.8 or SQLite < 3.8.3
+                self.con.create_function(name, nargs, fn)
+                self.deterministic = False
+
+    def set_profile(self, name):
+        '''Apply the connection settings listed under `name` in `PROFILES`.'''
+        if name not in PROFILES:
+            raise ValueError(f"Unknown database profile '{name}'.")
+        if self.con.in_transaction:
+            raise ValueError('Cannot change database profile during a transaction.')
+        for pragma, value in PROFILES[name].items():
+            self.cur.execute(f'PRAGMA {pragma} = {value}')
+            self.cur.fetchall()
+        self.profile_name = name
+
+    @contextlib.contextmanager
+    def use_profile(self, name):
+        '''Switch to profile `name` for the duration of a `with` block
+        and then switch back to the previous profile (or to `safe`).'''
+        previous = self.profile_name or 'safe'
+        self.set_profile(name)
+        try:
+            yield None
+        finally:
+            self.con.commit()
+            self.set_profile(previous)
+
+    def schema_version(self):
+        self.cur.execute('SELECT schema_major, schema_minor FROM metadata')
+        return tuple(self.cur.fetchone())
+
+    def migrate(self):
+        '''Bring the schema up to date by running any entries in
+        `MIGRATIONS` which are newer than the current version.'''
+        version = self.schema_version()
+        latest = MIGRATIONS[-1][0]
+        if version > latest:
+            raise ValueError(f'Database {self.path} has schema version {version[0]}.{version[1]}, which is newer than this version of reBabel supports.')
+        for target, script in MIGRATIONS:
+            if target <= version:
+                continue
+            try:
+                self.con.executescript(
+                    'BEGIN;\n' + script +
+                    f'\nUPDATE metadata SET schema_major = {target[0]}, schema_minor = {target[1]};\nCOMMIT;'
+                )
+            except sql.Error:
+                # leave the file at the last version that succeeded
+                if self.con.in_transaction:
+                    self.con.rollback()
+                raise
+            version = target
+
+    def analyze(self, common_values=10):
+        '''Recompute the statistics in `self.stats`, keeping the
+        `common_values` most frequent values of each tier, and update
+        SQLite's own statistics.'''
+        with self.transaction():
+            self.cur.execute('DELETE FROM unit_type_stats')
+            self.cur.execute('DELETE FROM tier_stats')
+            self.cur.execute('DELETE FROM tier_common_values')
+            self.cur.execute('INSERT INTO unit_type_stats(type, count) SELECT type, COUNT(*) FROM units GROUP BY type')
+            self.cur.execute('INSERT INTO tier_stats(tier, count, distinct_values) SELECT feature, COUNT(*), COUNT(DISTINCT value) FROM features GROUP BY feature')
+            self.cur.execute('SELECT tier FROM tier_stats')
+            for (tier,) in self.cur.fetchall():
+                self.cur.execute(
+                    'INSERT INTO tier_common_values(tier, value, count) SELECT feature, value, COUNT(*) AS n FROM features WHERE feature = ? GROUP BY value ORDER BY n DESC LIMIT ?',
+                    (tier, common_values))
+            self.cur.execute('ANALYZE')
+        self.stats.reload()
+
+    def create_text_index(self):
+        '''Create (or rebuild) a trigram index of string feature values,
+        which the `contains`, `startswith`, and `endswith` query operators
+        use when it exists. Triggers keep it up to date, but since it
+        refers to features by rowid, it must be rebuilt after a VACUUM.
+        This requires SQLite to have been built with FTS5.'''
+        self.drop_text_index()
+        with self.transaction():
+            try:
+                self.cur.execute("CREATE VIRTUAL TABLE features_fts USING fts5(value, content='features', tokenize='trigram')")
+            except sql.OperationalError as e:
+                raise ValueError(f'Unable to create text index: {e}')
+            self.cur.execute("INSERT INTO features_fts(rowid, value) SELECT rowid, value FROM features WHERE typeof(value) = 'text'")
+            for event, statements in [
+                    ('INSERT', ['insert']),
+                    ('UPDATE', ['delete', 'insert']),
+                    ('DELETE', ['delete'])]:
+                body = ''
+                for stmt in statements:
+                    if stmt == 'insert':
+                        body += "INSERT INTO features_fts(rowid, value) SELECT NEW.rowid, NEW.value WHERE typeof(NEW.value) = 'text';\n"
+                    else:
+                        body += "INSERT INTO features_fts(features_fts, rowid, value) SELECT 'delete', OLD.rowid, OLD.value WHERE typeof(OLD.value) = 'text';\n"
+                self.cur.execute(f'CREATE TRIGGER features_fts_{event.lower()} AFTER {event} ON features BEGIN\n{body}END')
+        self.text_index = True
+        # compiled queries may now be able to use it
+        self.query_cache.clear()
+
+    def create_casefold_index(self):
+        '''Index the case-folded values of features, so that `iequals`
+        conditions don't need to check every value of the feature.
+        Since the index uses a function defined by `RBBLFile`, other
+        programs will be unable to modify the `features` table of the
+        database until it is removed with `drop_casefold_index()`.'''
+        if not self.deterministic:
+            raise ValueError('Indexing case-folded values requires Python 3.8 and SQLite 3.8.3 or later.')
+        with self.transaction():
+            self.cur.execute('CREATE INDEX IF NOT EXISTS features_casefold ON features(feature, rbbl_casefold(value))')
+
+    def drop_casefold_index(self):
+        '''Remove the index created by `create_casefold_index()`, if any.'''
+        with self.transaction():
+            self.cur.execute('DROP INDEX IF EXISTS features_casefold')
+
+    def drop_text_index(self):
+        '''Remove the index created by `create_text_index()`, if any.'''
+        with self.transaction():
+            for event in ['insert', 'update', 'delete']:
+                self.cur.execute(f'DROP TRIGGER IF EXISTS features_fts_{event}')
+            self.cur.execute('DROP TABLE IF EXISTS features_fts')
+        self.text_index = False
+        self.query_cache.clear()
 
     def first(self, qr, *args):
         self.cur.execute(qr + ' LIMIT 1', args)
@@ -118,7 +572,68 @@ class RBBLFile:
 
     def commit(self):
         if self.committing:
+            if self.con.total_changes != self.changes_seen:
+                # the triggers only catch edits and deletions of features
+                self.cur.execute('UPDATE metadata SET generation = generation + 1')
+            self.con.commit()
+            self.changes_seen = self.con.total_changes
+
+    def change_generation(self):
+        '''Return a number which changes whenever the contents of the
+        database do, or `None` if this connection has uncommitted
+        changes.'''
+        if self.con.total_changes != self.changes_seen:
+            return None
+        self.cur.execute('SELECT generation FROM metadata')
+        return self.cur.fetchone()[0]
+
+    @staticmethod
+    def encode_rows(obj):
+        def default(val):
+            if isinstance(val, bytes):
+                return {'b': val.hex()}
+            raise TypeError(f'Cannot cache value {val!r}.')
+        return json.dumps(obj, default=default)
+
+    @staticmethod
+    def decode_rows(text):
+        def hook(dct):
+            return bytes.fromhex(dct['b'])
+        return [tuple(row) for row in json.loads(text, object_hook=hook)]
+
+    def fetch_cached(self, qr, params):
+        '''Run the SELECT statement `qr` and return all the rows.
+
+        If `self.result_cache` is true, the rows are also stored in the
+        database and returned directly by later calls with the same
+        statement and parameters, until the database is changed.'''
+        if not self.result_cache:
+            self.cur.execute(qr, params)
+            return self.cur.fetchall()
+        generation = self.change_generation()
+        try:
+            key = hashlib.sha256(self.encode_rows([qr, params]).encode()).hexdigest()
+        except TypeError:
+            generation = None
+        if generation is not None:
+            self.cur.execute('SELECT generation, result FROM result_cache WHERE key = ?', (key,))
+            row = self.cur.fetchone()
+            if row is not None and row[0] == generation:
+                return self.decode_rows(row[1])
+        self.cur.execute(qr, params)
+        rows = self.cur.fetchall()
+        if generation is not None:
+            try:
+                text = self.encode_rows(rows)
+            except TypeError:
+                return rows
+            self.cur.execute('DELETE FROM result_cache WHERE generation != ?', (generation,))
+            self.cur.execute('INSERT OR REPLACE INTO result_cache(key, generation, result) VALUES(?, ?, ?)',
+                             (key, generation, text))
             self.con.commit()
+            # this isn't a change to the contents
+            self.changes_seen = self.con.total_changes
+        return rows
 
     def set_time(self, dt):
         self.current_time = dt
@@ -132,6 +647,17 @@ class RBBLFile:
             terms.append(t)
         self.cur.execute(prefix + ' WHERE ' + ' AND '.join(terms), params)
 
+    def fetch_clauses(self, prefix, *clauses):
+        '''Like `execute_clauses()`, but return the rows using
+        `fetch_cached()`.'''
+        params = []
+        terms = []
+        for c in clauses:
+            t, p = c.toSQL()
+            params += p
+            terms.append(t)
+        return self.fetch_cached(prefix + ' WHERE ' + ' AND '.join(terms), params)
+
     def interpret_value(self, value, valuetype):
         if value is None:
             return value
@@ -164,10 +690,11 @@ class RBBLFile:
     def ensure_type(self, typename: str) -> bool:
         '''Ensure that a unit type named `typename` exists.
         return whether it was created.'''
-        ex = self.first('SELECT * FROM tiers WHERE unittype = ?', typename)
-        if ex is None:
+        # every unit type has meta:active, so we can check for that
+        if self.catalog.get(typename, 'meta:active') is None:
             self.insert('tiers', ('name', 'meta:active'),
                         ('unittype', typename), ('valuetype', 'bool'))
+            self.catalog.add(self.cur.lastrowid, 'meta:active', typename, 'bool')
             return True
         return False
 
@@ -179,9 +706,10 @@ class RBBLFile:
             # TODO: check if already exists
             self.insert('tiers', ('name', feature),
                         ('unittype', unittype), ('valuetype', valuetype))
+            self.catalog.add(self.cur.lastrowid, feature, unittype, valuetype)
 
     def get_feature(self, unittype, feature, error=False):
-        ret = self.first('SELECT id, valuetype FROM tiers WHERE unittype = ? AND name = ?', unittype, feature)
+        ret = self.catalog.get(unittype, feature)
         if ret is None:
             if error:
                 raise ValueError('Feature %s does not exist for unit type %s.' % (feature, unittype))
@@ -189,12 +717,11 @@ class RBBLFile:
         return ret
 
     def get_feature_multi_type(self, unittypes, feature, error=False):
-        self.execute_clauses(
-            'SELECT id, valuetype FROM tiers',
-            WhereClause('name', feature),
-            WhereClause('unittype', unittypes),
-        )
-        ret = self.cur.fetchall()
+        ret = []
+        for unittype in utils.as_list(unittypes):
+            tier = self.catalog.get(unittype, feature)
+            if tier is not None:
+                ret.append(tier)
         if error and not ret:
             raise ValueError(f"Feature '{feature}' does not exist for unit type {unittypes}.")
         return ret
@@ -206,10 +733,45 @@ class RBBLFile:
             self.insert('units', ('type', unittype), ('created', self.now()),
                         ('modified', self.now()), ('active', True))
             uid = self.cur.lastrowid
+            self.cache_unit_type(uid, unittype)
             self.insert('features', ('unit', uid), ('feature', meta),
                         ('value', True), ('date', self.now()), ('user', user))
             return uid
 
+    def create_units_many(self, unittypes, user=None):
+        '''Create one unit for each type in `unittypes` and return
+        a list of their IDs.
+
+        The IDs are allocated as a consecutive range following the
+        current largest ID, which is the same sequence that repeated
+        calls to `create_unit` would produce. The write lock is taken
+        first, so no other connection can create units in between.'''
+        unittypes = list(unittypes)
+        if not unittypes:
+            return []
+        with self.transaction():
+            if not self.con.in_transaction:
+                self.cur.execute('BEGIN IMMEDIATE')
+            meta = {}
+            for unittype in set(unittypes):
+                self.ensure_type(unittype)
+                meta[unittype] = self.get_feature(unittype, 'meta:active')[0]
+            start = (self.first('SELECT MAX(id) FROM units')[0] or 0) + 1
+            ids = list(range(start, start + len(unittypes)))
+            now = self.now()
+            self.cur.executemany(
+                'INSERT INTO units(id, type, created, modified, active) VALUES(?, ?, ?, ?, ?)',
+                [(uid, typ, now, now, True) for uid, typ in zip(ids, unittypes)],
+            )
+            self.cur.executemany(
+                'INSERT INTO features(unit, feature, value, date, user) VALUES(?, ?, ?, ?, ?)',
+                [(uid, meta[typ], True, now, user)
+                 for uid, typ in zip(ids, unittypes)],
+            )
+        for uid, typ in zip(ids, unittypes):
+            self.cache_unit_type(uid, typ)
+        return ids
+
     def create_unit_with_features(self, unittype: str, feats, user, parent=None) -> int:
         with self.transaction():
             uid = self.create_unit(unittype, user)
@@ -225,29 +787,80 @@ class RBBLFile:
                             ('child', uid), ('child_type', unittype),
                             ('isprimary', True), ('active', True),
                             ('date', self.now()))
+                self.update_ancestry([uid])
             return uid
 
     def rem_unit(self, unitid: int, user: str):
         with self.transaction():
             params = {'active': False, 'unit': unitid}
             self.cur.execute(
-                'UPDATE relations SET active = :active WHERE parent = :unit OR child = :unit',
-                params,
+                'SELECT parent, child FROM relations WHERE (parent = :unit OR child = :unit) AND active = :active',
+                {'active': True, 'unit': unitid},
             )
-            # TODO: why do we have both unit.active and meta:active?
+            related = set(u for row in self.cur.fetchall() for u in row)
             self.cur.execute(
-                'UPDATE units SET active = :active WHERE id = :unit',
+                'UPDATE relations SET active = :active WHERE parent = :unit OR child = :unit',
                 params,
             )
+            self.touch_units(sorted(related - {unitid}))
+            self.update_ancestry([unitid])
             self.set_feature(unitid, 'meta:active', False, user)
 
     def get_unit_type(self, unitid: int) -> str:
+        ret = self.unit_types.get(unitid)
+        if ret is not None:
+            self.unit_types.move_to_end(unitid)
+            return ret
         ret = self.first('SELECT type FROM units WHERE id = ?', unitid)
         if ret is None:
             raise ValueError('Unit %s does not exist.' % unitid)
+        self.cache_unit_type(unitid, ret[0])
         return ret[0]
 
-    def check_type(self, typename, value):
+    def get_unit_types(self, ids, chunk_size=500):
+        '''Return a dictionary mapping each of `ids` to its unit type.'''
+        ret = {}
+        todo = []
+        for uid in ids:
+            if uid in self.unit_types:
+                ret[uid] = self.unit_types[uid]
+            else:
+                todo.append(uid)
+        todo = sorted(set(todo))
+        for start in range(0, len(todo), chunk_size):
+            self.execute_clauses('SELECT id, type FROM units',
+                                 WhereClause('id', todo[start:start+chunk_size]))
+            for uid, unittype in self.cur.fetchall():
+                ret[uid] = unittype
+                self.cache_unit_type(uid, unittype)
+        for uid in todo:
+            if uid not in ret:
+                raise ValueError('Unit %s does not exist.' % uid)
+        return ret
+
+    def cache_unit_type(self, unitid: int, unittype: str):
+        if self.unit_type_cache_size <= 0:
+            return
+        self.unit_types[unitid] = unittype
+        self.unit_types.move_to_end(unitid)
+        while len(self.unit_types) > self.unit_type_cache_size:
+            self.unit_types.popitem(last=False)
+
+    def prefetch_unit_types(self, ids, chunk_size=500):
+        '''Load the types of `ids` into the unit type cache, one query
+        per `chunk_size` units. Since loading more units than the cache
+        can hold would just evict the earlier ones, only the first
+        `unit_type_cache_size` missing units are loaded.'''
+        todo = [i for i in ids if i not in self.unit_types]
+        todo = todo[:self.unit_type_cache_size]
+        for start in range(0, len(todo), chunk_size):
+            self.execute_clauses('SELECT id, type FROM units',
+                                 WhereClause('id', todo[start:start+chunk_size]))
+            for uid, unittype in self.cur.fetchall():
+                self.cache_unit_type(uid, unittype)
+
+    @staticmethod
+    def check_type(typename, value):
         if typename == 'str' and not isinstance(value, str):
             raise ValueError()
         elif typename == 'bool' and not isinstance(value, bool):
@@ -271,6 +884,89 @@ class RBBLFile:
                 'INSERT OR IGNORE INTO features(unit, feature, value, user, confidence, date) VALUES(:unit, :feature, :value, :user, :confidence, :date)',
                 params,
             )
+            if feature == 'meta:active':
+                self.sync_active([unitid])
+            self.touch_units([unitid])
+
+    def sync_active(self, unitids):
+        '''Copy the `meta:active` feature of each unit in `unitids` to
+        `units.active`, which is what queries check. Anything which
+        writes `meta:active` must call this afterwards.'''
+        self.cur.executemany(
+            'UPDATE units SET active = (SELECT F.value FROM features F JOIN tiers T ON F.feature = T.id WHERE F.unit = units.id AND T.name = ?) WHERE id = ?',
+            [('meta:active', uid) for uid in unitids],
+        )
+
+    def touch_units(self, unitids):
+        '''Set the modification time of each unit in `unitids` to now.
+        The triggers only do this when a feature is edited or deleted,
+        so anything which adds features or changes relations must call
+        this.'''
+        now = self.now()
+        self.cur.executemany('UPDATE units SET modified = ? WHERE id = ?',
+                             [(now, uid) for uid in unitids])
+
+    def update_ancestry(self, unitids):
+        '''Recompute the rows of the `ancestry` table for each unit in
+        `unitids` and all of its descendants. This must be called after
+        changing any primary relation, with the child of that relation.'''
+        ids = json.dumps(sorted(set(unitids)))
+        self.cur.execute('CREATE TEMP TABLE IF NOT EXISTS ancestry_update(unit INTEGER PRIMARY KEY)')
+        self.cur.execute('DELETE FROM temp.ancestry_update')
+        self.cur.execute(
+            'INSERT OR IGNORE INTO temp.ancestry_update SELECT value FROM json_each(?) UNION SELECT descendant FROM ancestry WHERE ancestor IN (SELECT value FROM json_each(?))',
+            (ids, ids))
+        self.cur.execute('DELETE FROM ancestry WHERE descendant IN temp.ancestry_update')
+        self.cur.execute(
+            '''WITH RECURSIVE up(descendant, ancestor) AS (
+            SELECT child, parent FROM relations
+            WHERE child IN temp.ancestry_update AND isprimary = ? AND active = ?
+            UNION
+            SELECT up.descendant, R.parent FROM up JOIN relations R
+            ON R.child = up.ancestor WHERE R.isprimary = ? AND R.active = ?
+            )
+            INSERT OR IGNORE INTO ancestry(ancestor, descendant)
+            SELECT ancestor, descendant FROM up''',
+            (True, True, True, True))
+
+    def set_features_many(self, items):
+        '''Set many features at once.
+
+        `items` is an iterable of `(unit, feature, value, user, confidence)`
+        tuples. All values are checked before anything is written, so
+        a type error will leave the database unchanged. If the same
+        feature is given more than once for a unit, only the last value
+        is written.'''
+        items = list(items)
+        types = self.get_unit_types([it[0] for it in items])
+        tiers = {}
+        rows = {}
+        active = set()
+        now = self.now()
+        for unitid, feature, value, user, confidence in items:
+            key = (types[unitid], feature)
+            if key not in tiers:
+                tiers[key] = self.get_feature(*key, error=True)
+            fid, typ = tiers[key]
+            self.check_type(typ, value)
+            if feature == 'meta:active':
+                active.add(unitid)
+            rows[(unitid, fid)] = {
+                'unit': unitid, 'feature': fid, 'value': value, 'user': user,
+                'confidence': confidence, 'date': now,
+            }
+        with self.transaction():
+            # the edit trigger records history for the rows which change
+            self.cur.executemany(
+                'UPDATE features SET value = :value, user = :user, confidence = :confidence, date = :date WHERE unit = :unit AND feature = :feature',
+                rows.values(),
+            )
+            self.cur.executemany(
+                'INSERT OR IGNORE INTO features(unit, feature, value, user, confidence, date) VALUES(:unit, :feature, :value, :user, :confidence, :date)',
+                rows.values(),
+            )
+            self.sync_active(sorted(active))
+            self.touch_units(sorted(set(r['unit'] for r in rows.values())))
 
     def set_feature_dist(self, unitid: int, feature: str,
                          values, normalize=True):
@@ -295,10 +991,15 @@ class RBBLFile:
     def rem_feature(self, unitid: int, feature: str):
         unittype = self.get_unit_type(unitid)
         fid, typ = self.get_feature(unittype, feature, error=True)
-        self.cur.execute(
-            'DELETE FROM features WHERE unit = :unit AND feature = :feature',
-            {'unit': unitid, 'feature': fid},
-        )
+        with self.transaction():
+            self.cur.execute(
+                'DELETE FROM features WHERE unit = :unit AND feature = :feature',
+                {'unit': unitid, 'feature': fid},
+            )
+            if feature == 'meta:active':
+                self.sync_active([unitid])
+            # the trigger uses UTC rather than self.now()
+            self.touch_units([unitid])
 
     def rem_parent(self, parent: int, child: int, primary_only=False):
         qr = 'UPDATE relations SET active = ? WHERE parent = ? AND child = ?'
@@ -306,7 +1007,10 @@ class RBBLFile:
         if primary_only:
             qr += ' AND isprimary = ?'
             args.append(True)
-        self.cur.execute(qr, args)
+        with self.transaction():
+            self.cur.execute(qr, args)
+            self.touch_units([parent, child])
+            self.update_ancestry([child])
 
     def set_parent(self, parent: int, child: int, primary=True, clear=True):
         ptyp = self.get_unit_type(parent)
@@ -318,6 +1022,33 @@ class RBBLFile:
                         ('child', child), ('child_type', ctyp),
                         ('isprimary', primary), ('active', True),
                         ('date', self.now()))
+            self.touch_units([parent, child])
+            if primary:
+                self.update_ancestry([child])
+
+    def set_parents_many(self, pairs, primary=True, clear=True):
+        '''Equivalent to calling `set_parent(parent, child, primary, clear)`
+        for each `(parent, child)` in `pairs`.'''
+        pairs = list(pairs)
+        types = self.get_unit_types([u for pair in pairs for u in pair])
+        now = self.now()
+        with self.transaction():
+            if primary or clear:
+                qr = 'UPDATE relations SET active = ? WHERE parent = ? AND child = ?'
+                if clear:
+                    args = [(False, p, c) for p, c in pairs]
+                else:
+                    qr += ' AND isprimary = ?'
+                    args = [(False, p, c, True) for p, c in pairs]
+                self.cur.executemany(qr, args)
+            self.cur.executemany(
+                'INSERT INTO relations(parent, parent_type, child, child_type, isprimary, active, date) VALUES(?, ?, ?, ?, ?, ?, ?)',
+                [(p, types[p], c, types[c], primary, True, now)
+                 for p, c in pairs],
+            )
+            self.touch_units(sorted(set(u for pair in pairs for u in pair)))
+            if primary or clear:
+                self.update_ancestry([c for p, c in pairs])
 
     def get_parent(self, uid: int):
         ret = self.first('SELECT parent FROM relations WHERE child = ? AND isprimary = ? AND active = ?', uid, True, True)
@@ -354,13 +1085,13 @@ class RBBLFile:
         return [x[0] for x in self.cur.fetchall()]
 
     def get_children(self, units: list, child_type: str):
-        self.execute_clauses('SELECT parent, child FROM relations',
-                             WhereClause('parent', units),
-                             WhereClause('child_type', child_type),
-                             WhereClause('active', True),
-                             WhereClause('isprimary', True))
+        rows = self.fetch_clauses('SELECT parent, child FROM relations',
+                                  WhereClause('parent', units),
+                                  WhereClause('child_type', child_type),
+                                  WhereClause('active', True),
+                                  WhereClause('isprimary', True))
         ret = defaultdict(list)
-        for parent, child in self.cur.fetchall():
+        for parent, child in rows:
             ret[parent].append(child)
         return ret
 
@@ -379,10 +1110,9 @@ class RBBLFile:
         return ret
 
     def get_feature_values(self, units, featid):
-        self.execute_clauses('SELECT unit, value FROM features',
-                             WhereClause('unit', units),
-                             WhereClause('feature', featid))
-        return dict(self.cur.fetchall())
+        return dict(self.fetch_clauses('SELECT unit, value FROM features',
+                                       WhereClause('unit', units),
+                                       WhereClause('feature', featid)))
 
     def get_feature_value_by_name(self, unitid: int, feature: str):
         unittype = self.get_unit_type(unitid)
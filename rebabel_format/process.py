@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-from rebabel_format.db import RBBLFile
+from rebabel_format.db import RBBLFile, PROFILES
 from rebabel_format.parameters import Parameter, DBParameter, QueryParameter, process_parameters
 import logging
 
@@ -10,11 +10,18 @@ class Process:
     name = None
     parameters = {}
     db = DBParameter(help='the database file to operate on')
+    db_profile = Parameter(type=str, required=False, choices=sorted(PROFILES),
+                           help='the connection settings to use for the database')
+    cache_results = Parameter(type=bool, default=False, help='store query results in the database and reuse them until it is modified')
 
     def __init__(self, conf, **kwargs):
         self.conf = conf
         self.other_args = kwargs
         self.parameter_values = process_parameters(self.parameters, conf, self.name, kwargs)
+        if self.db_profile:
+            self.db.set_profile(self.db_profile)
+        if self.cache_results:
+            self.db.result_cache = True
         self.logger = logging.getLogger('reBabel.' + (self.name or 'unnamed_process'))
 
     def __init_subclass__(cls, *args, **kwargs):
@@ -54,6 +61,10 @@ class Process:
 
 class SearchProcess(Process):
     query = QueryParameter()
+    since = Parameter(type=str, required=False, help='only report matches containing a unit modified after this time')
+    limit = Parameter(type=int, required=False, help='the maximum number of matches to report')
+    offset = Parameter(type=int, required=False, help='the number of matches to skip before reporting any')
+    sample = Parameter(type=int, required=False, help='report this many matches chosen at random')
 
     def get_value(self, result, spec):
         uid = result[spec['unit']]
@@ -78,6 +89,9 @@ class SearchProcess(Process):
     def run(self):
         from rebabel_format.query import search
         self.pre_search()
-        for result in search(self.db, self.query):
+        for result in search(self.db, self.query, prefetch_types=True,
+                             stream=True, since=self.since,
+                             limit=self.limit, offset=self.offset,
+                             sample=self.sample):
             self.per_result(result)
         self.post_search()
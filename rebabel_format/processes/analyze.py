@@ -0,0 +1,19 @@
+#!/usr/bin/env python3
+
+from rebabel_format.process import Process
+from rebabel_format.parameters import Parameter
+
+class Analyze(Process):
+    '''Update the statistics used to plan queries'''
+
+    name = 'analyze'
+    common_values = Parameter(type=int, default=10, help='the number of most frequent values to record for each feature')
+    text_index = Parameter(type=bool, default=False, help='also build a trigram index of string values for contains, startswith, and endswith')
+    casefold_index = Parameter(type=bool, default=False, help='also index case-folded values for iequals (other programs will be unable to modify features)')
+
+    def run(self):
+        if self.text_index:
+            self.db.create_text_index()
+        if self.casefold_index:
+            self.db.create_casefold_index()
+        self.db.analyze(self.common_values)
@@ -1,6 +1,6 @@
 from rebabel_format.process import Process
 from rebabel_format.parameters import Parameter, QueryParameter
-from rebabel_format.query import ResultTable
+from rebabel_format.query import Query
 
 from collections import Counter, defaultdict
 from itertools import combinations
@@ -15,23 +15,24 @@ class ConditionalProbability(Process):
     max_combinations = Parameter(type=int, default=2)
 
     def run(self):
-        table = ResultTable(self.db, self.query)
-        table.add_features(self.center, [self.target_feature] + self.features)
+        Q = Query.parse_query(self.db, self.query)
+        names = [self.target_feature] + self.features
+        groups = Q.aggregate([(self.center, f) for f in names])
 
         result_count = 0
         target_count = 0
         results = defaultdict(lambda: defaultdict(Counter))
-        for nodes, features in table.results():
-            result_count += 1
-            dct = features.get(nodes.get(self.center), {})
-            if self.target_feature not in dct:
+        for values, count in groups:
+            result_count += count
+            if values[0] is None:
                 continue
-            target_count += 1
-            names = [k for k in dct if k in self.features]
+            target_count += count
+            dct = {k: v for k, v in zip(self.features, values[1:])
+                   if v is not None}
             for i in range(self.max_combinations+1):
-                for keys in combinations(names, i):
-                    values = tuple([dct[k] for k in keys])
-                    results[keys][values][dct[self.target_feature]] += 1
+                for keys in combinations(list(dct), i):
+                    vals = tuple([dct[k] for k in keys])
+                    results[keys][vals][values[0]] += count
 
         for condition in sorted(results.keys(), key=lambda x: (len(x), x)):
             print(f'Conditioning on {", ".join(condition)}:')
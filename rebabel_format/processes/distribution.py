@@ -2,8 +2,7 @@
 
 from rebabel_format.process import Process
 from rebabel_format.parameters import Parameter, QueryParameter
-from rebabel_format.query import ResultTable
-from collections import Counter
+from rebabel_format.query import Query
 
 # TODO: this process seems oddly specific
 # perhaps queries should support getting arbitrary numbers of children,
@@ -20,38 +19,60 @@ class Distribution(Process):
     sort = Parameter(default='meta:index', type=str, help='the feature to use for sorting')
     include = Parameter(default=[], type=list, help='features from the pattern to include when counting')
 
-    def display_unit(self, features):
+    def display_value(self, table, valuetype):
+        # match str() of the Python value
+        if valuetype == 'bool':
+            return f"(CASE WHEN {table}.value IS NULL THEN '_' WHEN {table}.value = X'30' THEN 'False' ELSE 'True' END)"
+        return f"COALESCE({table}.value, '_')"
+
+    def children_expression(self, Q):
+        '''Return SQL and parameters for the children of the center of
+        a match, each displayed as `feature1/feature2/...` (or `_` if
+        it is excluded), in sorted order and separated by tabs.'''
+        joins = ''
+        params = []
         pieces = []
-        for block in self.child_print:
-            val = features.get(block['fid'], '_')
-            if 'exclude' in block and val in block['exclude']:
-                return '_'
-            elif 'include' in block and val not in block['include']:
-                return '_'
-            pieces.append(str(val))
-        return '/'.join(pieces)
+        excluded = []
+        excluded_params = []
+        for n, block in enumerate(self.child_print):
+            fid, vtype = self.db.get_feature(self.child_type, block['feature'],
+                                             error=True)
+            joins += f' LEFT JOIN features P{n} ON P{n}.unit = CR.child AND P{n}.feature = ?'
+            params.append(fid)
+            val = self.display_value(f'P{n}', vtype)
+            pieces.append(val)
+            raw = f"COALESCE(P{n}.value, '_')"
+            if 'exclude' in block:
+                qs = ', '.join(['?']*len(block['exclude']))
+                excluded.append(f'{raw} IN ({qs})')
+                excluded_params += block['exclude']
+            elif 'include' in block:
+                qs = ', '.join(['?']*len(block['include']))
+                excluded.append(f'{raw} NOT IN ({qs})')
+                excluded_params += block['include']
+        sort_id, _ = self.db.get_feature(self.child_type, self.sort,
+                                         error=True)
+        joins += ' LEFT JOIN features CS ON CS.unit = CR.child AND CS.feature = ?'
+        params.append(sort_id)
+        item = " || '/' || ".join(pieces)
+        if excluded:
+            item = f"CASE WHEN {' OR '.join(excluded)} THEN '_' ELSE {item} END"
+        center = Q.name2unit[self.center].index
+        sql = f"(SELECT group_concat(item, char(9)) FROM (SELECT {item} AS item FROM relations CR{joins} WHERE CR.parent = M.U{center} AND CR.child_type = ? AND CR.isprimary = ? AND CR.active = ? ORDER BY COALESCE(CS.value, 0), CR.child))"
+        return sql, excluded_params + params + [self.child_type, True, True]
 
     def run(self):
-        rt = ResultTable(self.db, self.query)
-        chname = rt.add_children(self.center, self.child_type)
-        printids = rt.add_features(chname,
-                                   [cp['feature'] for cp in self.child_print])
-        for p, i in zip(self.child_print, printids):
-            p['fid'] = i
-        sortid = rt.add_features(chname, [self.sort])[0]
-        for inc in self.include:
-            inc['fid'] = rt.add_features(inc['unit'], [inc])[0]
-        count = Counter()
-        for nodes, features in rt.results():
-            children = sorted(nodes[chname],
-                              key=lambda c: features[c].get(sortid, 0))
-            line = []
-            for dct in self.include:
-                line.append(str(features[nodes[dct['unit']]].get(dct['fid'])))
-            for ch in children:
-                line.append(self.display_unit(features[ch]))
-            count['\t'.join(line)] += 1
+        Q = Query.parse_query(self.db, self.query)
+        if self.center not in Q.name2unit:
+            raise ValueError(f'No unit named {self.center}.')
+        groups = Q.aggregate(
+            [(inc['unit'], inc['feature']) for inc in self.include],
+            expressions=[self.children_expression(Q)])
         cols = ['Count'] + [x['feature'] for x in self.include] + ['Items']
         print('\t'.join(cols))
-        for pattern, count in count.most_common():
+        for values, count in groups:
+            line = [str(v) for v in values[:-1]]
+            if values[-1] is not None:
+                line.append(values[-1])
+            pattern = '\t'.join(line)
             print(f'{count}\t{pattern}')
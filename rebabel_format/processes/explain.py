@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+from rebabel_format.process import Process
+from rebabel_format.parameters import Parameter, QueryParameter
+import time
+
+class Explain(Process):
+    '''Show the SQL generated for a pattern and how SQLite will run it'''
+
+    name = 'explain'
+    query = QueryParameter(help='the pattern to explain')
+    execute = Parameter(type=bool, default=False, help='also run the pattern and report timings for each subquery')
+    max_params = Parameter(type=int, default=20, help='the maximum number of SQL parameters to print for each statement')
+
+    def timed(self, label, fn, *args):
+        start = time.perf_counter()
+        ret = fn(*args)
+        ms = (time.perf_counter() - start) * 1000
+        self.total += ms
+        self.timings.append((label, ms))
+        return ret
+
+    def print_params(self, params, indent):
+        if len(params) > self.max_params:
+            shown = ', '.join(repr(p) for p in params[:self.max_params])
+            print(f'{indent}Parameters: [{shown}, ...] ({len(params)} total)')
+        else:
+            print(f'{indent}Parameters: {params!r}')
+
+    def print_plan(self, sql, params, indent):
+        self.db.cur.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        depth = {0: 0}
+        print(f'{indent}Query plan:')
+        for node, parent, _, detail in self.db.cur.fetchall():
+            depth[node] = depth.get(parent, 0) + 1
+            print(indent + '  '*depth[node] + detail)
+
+    def print_query(self, label, Q, indent=''):
+        sql, params = Q.compiled
+        print(f'{indent}{label}:')
+        print(f'{indent}  SQL: {sql}')
+        self.print_params(params, indent+'  ')
+        self.print_plan(sql, params, indent+'  ')
+
+    def prepare_subqueries(self, Q, prefix):
+        # mirrors Query.prepare_subqueries, but times each step
+        for n, (sub, idx, mn, mx) in enumerate(Q.subqueries, 1):
+            label = f'{prefix}.{n}'
+            self.timed(f'Subquery {label} (unit {Q.units[idx].name}, min {mn}, max {mx})',
+                       sub.prepare_search, list(Q.unit_ids[idx]))
+            self.subqueries.append((label, sub))
+            if mn is not None and mn > 0 and not sub.results:
+                return False
+            if not self.prepare_subqueries(sub, label):
+                return False
+        return True
+
+    def run(self):
+        from rebabel_format.query import Query
+        self.timings = []
+        self.subqueries = []
+        self.total = 0.0
+
+        Q = self.timed('Parse', Query.parse_query, self.db, self.query)
+        self.timed('Compile', Q.compile)
+        self.print_query('Query', Q)
+
+        if not self.execute:
+            print('')
+            print('Timings:')
+            for label, ms in self.timings:
+                print(f'  {label}: {ms:.2f} ms')
+            return
+
+        # DISTINCT and ORDER BY are part of the SQL statement, so
+        # deduplication and sorting are included in this step
+        self.timed('Execute', Q.prepare_search)
+        rows = [('Execute', len(Q.results))]
+        ok = self.prepare_subqueries(Q, 'S')
+        results = []
+        if ok:
+            results = self.timed('Materialize', list, Q.get_results())
+
+        for label, sub in self.subqueries:
+            print('')
+            self.print_query(f'Subquery {label}', sub)
+            rows.append((f'Subquery {label}', len(sub.results)))
+
+        print('')
+        print('Timings:')
+        for label, ms in self.timings:
+            print(f'  {label}: {ms:.2f} ms')
+        print(f'  Total: {self.total:.2f} ms')
+        print('Rows:')
+        for label, count in rows:
+            print(f'  {label}: {count}')
+        print(f'  Results: {len(results)}')
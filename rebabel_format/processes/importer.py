@@ -12,6 +12,39 @@ class Importer(Process):
     infiles = Parameter(type=list, help='the paths to the files')
     glob = Parameter(type=bool, default=False, help='whether to perform glob expansion on the file names')
     mappings = MappingParameter(required=False, help='feature and type remappings')
+    workers = Parameter(type=int, default=1, help='the number of processes to parse files with (the database is always written by this one)')
+
+    def read_parallel(self, reader, fnames):
+        # files are written in order, so unit IDs are the same as they
+        # would be with a single process
+        from concurrent.futures import ProcessPoolExecutor
+        from collections import deque
+        from rebabel_format.reader import parse_file, ReaderError
+        import time
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            fnames = iter(fnames)
+            while True:
+                # stay a little ahead of the writer without keeping
+                # every parsed file in memory
+                while len(pending) < 2*self.workers:
+                    pth = next(fnames, None)
+                    if pth is None:
+                        break
+                    pending.append((pth, time.time(), pool.submit(
+                        parse_file, self.mode, self.username, self.conf,
+                        self.other_args, self.mappings, pth)))
+                if not pending:
+                    break
+                pth, start, future = pending.popleft()
+                blocks, ok = future.result()
+                try:
+                    reader.write_blocks(pth, blocks)
+                    if not ok:
+                        raise ReaderError()
+                    self.logger.info(f"Read '{pth}' in {time.time()-start} seconds.")
+                except ReaderError:
+                    self.logger.error(f"Import of '{pth}' failed.")
 
     def run(self):
         from rebabel_format.reader import ALL_READERS, ReaderError
@@ -28,13 +61,17 @@ class Importer(Process):
             fnames = itertools.chain.from_iterable(
                 map(lambda fname: sorted(glob.glob(fname)), self.infiles)
             )
-        for pth in fnames:
-            start = time.time()
-            try:
-                reader.read(pth)
-                self.logger.info(f"Read '{pth}' in {time.time()-start} seconds.")
-            except ReaderError:
-                self.logger.error(f"Import of '{pth}' failed.")
+        with self.db.use_profile(self.db_profile or 'bulk-import'):
+            if self.workers > 1:
+                self.read_parallel(reader, fnames)
+                return
+            for pth in fnames:
+                start = time.time()
+                try:
+                    reader.read(pth)
+                    self.logger.info(f"Read '{pth}' in {time.time()-start} seconds.")
+                except ReaderError:
+                    self.logger.error(f"Import of '{pth}' failed.")
 
     @classmethod
     def help_text_epilog(cls):
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 from rebabel_format.process import Process
-from rebabel_format.parameters import QueryParameter
+from rebabel_format.parameters import Parameter, QueryParameter
 from rebabel_format import utils
 
 class Search(Process):
@@ -9,6 +9,10 @@ class Search(Process):
 
     name = 'query'
     query = QueryParameter(help='the pattern to search for')
+    since = Parameter(type=str, required=False, help='only report matches containing a unit modified after this time')
+    limit = Parameter(type=int, required=False, help='the maximum number of matches to report')
+    offset = Parameter(type=int, required=False, help='the number of matches to skip before reporting any')
+    sample = Parameter(type=int, required=False, help='report this many matches chosen at random')
 
     def render_unit(self, name, uid):
         print(name, uid)
@@ -40,7 +44,10 @@ class Search(Process):
                     got_any = True
                 if not got_any:
                     raise ValueError(f"Could not find print feature '{feat}' for unit '{name}'.")
-        for n, result in enumerate(search(self.db, self.query), 1):
+        results = search(self.db, self.query, stream=True, since=self.since,
+                         limit=self.limit, offset=self.offset,
+                         sample=self.sample)
+        for n, result in enumerate(results, 1):
             print('Result', n)
             for name, uid in sorted(result.items()):
                 for u in utils.as_list(uid):
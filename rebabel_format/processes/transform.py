@@ -8,10 +8,13 @@ class Transform(Process):
     sequence = Parameter(type=list, help='the transformations to apply')
     user = UsernameParameter(help='the username to assign to changes')
     confidence = Parameter(default=1, type=int, help='the confidence value to assign to changes')
+    set_based = Parameter(type=bool, default=False, help='apply each command to all matches with a single SQL statement where possible')
+    since = Parameter(type=str, required=False, help='only apply rules to matches containing a unit modified after this time')
 
     def run(self):
         from rebabel_format.transform import transform
         from rebabel_format.config import get_single_param
         for rule in self.sequence:
             transform(self.db, get_single_param(self.conf, 'transform', rule),
-                      username=self.user, confidence=self.confidence)
+                      username=self.user, confidence=self.confidence,
+                      set_based=bool(self.set_based), since=self.since)
@@ -1,10 +1,13 @@
 #!/usr/bin/env python3
 
-from rebabel_format.db import RBBLFile, WhereClause
+from rebabel_format.db import RBBLFile, WhereClause, compile_pattern
 from rebabel_format import utils
 
 from collections import Counter, defaultdict
-from dataclasses import dataclass, field
+from dataclasses import dataclass, field, replace
+import itertools
+import json
+import random
 import re
 from typing import Any, Optional, Sequence
 
@@ -29,7 +32,18 @@ class Unit:
             raise ValueError(f'Child must be a Unit, not {other.__type__.__name__}')
         return Condition(self.index, other.index, 'child')
 
+    def ancestor(self, other):
+        if not isinstance(other, Unit):
+            raise ValueError(f'Ancestor must be a Unit, not {other.__type__.__name__}')
+        return Condition(self.index, other.index, 'ancestor')
+
+    def descendant(self, other):
+        if not isinstance(other, Unit):
+            raise ValueError(f'Descendant must be a Unit, not {other.__type__.__name__}')
+        return Condition(self.index, other.index, 'descendant')
+
     def subquery(self, min=1, max=None):
+        self.query.detach()
         ret = Query(self.query.db, self.query.type_map, self.query.feat_map)
         u = ret.unit(self.type, self.name)
         self.query.subqueries.append((ret, self.index, min, max))
@@ -62,6 +76,10 @@ class Condition:
             return f'EXISTS (SELECT NULL FROM relations WHERE parent = U{self.right} AND child = U{self.left} AND isprimary = ? AND active = ?)', [True, True], False
         elif self.operator == 'child':
             return f'EXISTS (SELECT NULL FROM relations WHERE child = U{self.right} AND parent = U{self.left} AND isprimary = ? AND active = ?)', [False, True], False
+        elif self.operator == 'ancestor':
+            return f'EXISTS (SELECT NULL FROM ancestry WHERE ancestor = U{self.right} AND descendant = U{self.left})', [], False
+        elif self.operator == 'descendant':
+            return f'EXISTS (SELECT NULL FROM ancestry WHERE ancestor = U{self.left} AND descendant = U{self.right})', [], False
         def _toSQL(obj):
             nonlocal self, query
             if isinstance(obj, Condition):
@@ -75,20 +93,46 @@ class Condition:
         op = self.operator
         if self.operator == '+' and (sl or sr):
             op = '||'
+        elif self.operator in ['matches', 'imatches']:
+            if isinstance(self.right, str):
+                # report invalid patterns now rather than from inside SQLite
+                compile_pattern(self.right)
+            return f'rbbl_{self.operator}({ql}, {qr})', al+ar, False
+        elif self.operator == 'iequals':
+            return f'rbbl_casefold({ql}) = rbbl_casefold({qr})', al+ar, False
         elif self.operator in ['startswith', 'contains', 'endswith']:
             # TODO: maybe use create_function to define these better
             op = 'LIKE'
             if self.operator != 'startswith':
                 qr = "'%' || " + qr
-            if self.operator != 'endsswith':
+            if self.operator != 'endswith':
                 qr += " || '%'"
+            if self.uses_text_index(query):
+                # the trigram index narrows down the candidates, but
+                # the LIKE is still needed to check them exactly
+                idx = query.get_feature(self.left.left, self.left.right, False)[0]
+                return f'(F{idx}.rowid IN (SELECT rowid FROM features_fts WHERE value LIKE ({qr})) AND ({ql}) {op} ({qr}))', ar+al+ar, False
         return f'({ql}) {op} ({qr})', al+ar, False
 
+    def uses_text_index(self, query):
+        '''Whether this string comparison can be narrowed down with
+        `features_fts` (see `RBBLFile.create_text_index()`). Trigrams
+        can't help with literal patterns shorter than 3 characters, but
+        values in cached queries aren't known until they are run.'''
+        if not query.db.text_index:
+            return False
+        if not (isinstance(self.left, Condition) and self.left.operator == 'feature'):
+            return False
+        if isinstance(self.right, str):
+            return len(self.right) >= 3
+        return isinstance(self.right, Slot)
+
     def add_to_query(self, query):
         if self.operator in ['parent', 'child']:
             table = f'R{query.relation_count}'
             query.relation_count += 1
             query.select_tables.append(f'relations {table}')
+            query.table_units[f'relations {table}'] = {self.left, self.right}
             query.where_conds += [
                 f'{table}.isprimary = ?',
                 f'{table}.active = ?',
@@ -104,8 +148,34 @@ class Condition:
                     f'{table}.parent = U{self.left}',
                     f'{table}.child = U{self.right}',
                 ]
+        elif self.operator in ['ancestor', 'descendant']:
+            table = f'R{query.relation_count}'
+            query.relation_count += 1
+            query.select_tables.append(f'ancestry {table}')
+            query.table_units[f'ancestry {table}'] = {self.left, self.right}
+            anc, desc = self.right, self.left
+            if self.operator == 'descendant':
+                anc, desc = desc, anc
+            query.where_conds += [
+                f'{table}.ancestor = U{anc}',
+                f'{table}.descendant = U{desc}',
+            ]
         else:
+            if (isinstance(self.left, Condition)
+                and self.left.operator == 'feature'
+                and not isinstance(self.right, (Condition, Unit))):
+                if self.operator == '=':
+                    query.value_conds.append((self.left.left, self.left.right,
+                                              self.right))
+                elif self.operator in Query.selectivity:
+                    query.filter_conds.append(
+                        (self.left.left, self.left.right,
+                         'indexed' if self.uses_text_index(query)
+                         else self.operator))
             s, p, _ = self.toSQL(query)
+            if self.operator == 'OR':
+                # the conditions are joined with AND
+                s = f'({s})'
             query.where_conds.append(s)
             query.params += p
 
@@ -171,6 +241,15 @@ class Condition:
     def endswith(self, other):
         return Condition(self, other, 'endswith')
 
+    def matches(self, other):
+        return Condition(self, other, 'matches')
+
+    def imatches(self, other):
+        return Condition(self, other, 'imatches')
+
+    def iequals(self, other):
+        return Condition(self, other, 'iequals')
+
     def __lt__(self, other):
         return Condition(self, other, '<')
     def __gt__(self, other):
@@ -189,8 +268,96 @@ class Condition:
             raise ValueError('.exists() only makes sense for features.')
         return Condition(self.left, self.right, 'exists')
 
+    def pattern_slots(self):
+        '''Yield the index of each `Slot` which is used as a regular
+        expression by this condition or any part of it.'''
+        if self.operator in ['matches', 'imatches'] and isinstance(self.right, Slot):
+            yield self.right.index
+        for side in [self.left, self.right]:
+            if isinstance(side, Condition):
+                yield from side.pattern_slots()
+
+class Slot:
+    '''A placeholder for a feature value in a cached query dictionary,
+    so that queries which only differ in those values can share
+    a compiled template.'''
+
+    def __init__(self, index):
+        self.index = index
+
+    def __repr__(self):
+        return f'Slot({self.index})'
+
+def template_key(query, order, type_map, feat_map):
+    '''Return `(key, values, template)`, where `template` is `query` with
+    each feature value replaced by a `Slot` into `values` and `key`
+    identifies the structure of `query`. Return `None` if `query`
+    can't be cached.'''
+    values = []
+
+    def slot(val):
+        values.append(val)
+        return Slot(len(values) - 1)
+
+    def walk_spec(spec):
+        if not isinstance(spec, dict):
+            return spec
+        ret = {}
+        for key, val in sorted(spec.items()):
+            if key.startswith('value') and not key.endswith('exist'):
+                if isinstance(val, list):
+                    val = [slot(v) for v in val]
+                else:
+                    val = slot(val)
+            ret[key] = val
+        return ret
+
+    def walk_query(dct):
+        ret = {}
+        for key, pattern in sorted(dct.items()):
+            if isinstance(pattern, dict):
+                pattern = dict(pattern)
+                if 'features' in pattern:
+                    pattern['features'] = [walk_spec(f) for f in pattern['features']]
+                if 'subqueries' in pattern:
+                    pattern['subqueries'] = [walk_query(q) for q in pattern['subqueries']]
+            ret[key] = pattern
+        return ret
+
+    if isinstance(query, dict):
+        template = walk_query(query)
+    elif isinstance(query, str):
+        template = query
+    else:
+        return None
+    def encode(obj):
+        if isinstance(obj, Slot):
+            return ['slot', type(values[obj.index]).__name__]
+        raise TypeError
+    try:
+        key = json.dumps([template, order, type_map, feat_map],
+                         sort_keys=True, default=encode)
+    except (TypeError, ValueError):
+        return None
+    return key, values, template
+
 class Query:
     token_re = re.compile(r'[()\.]|"(?:[^"\\]|\\.)*"|[^\s()\."]+')
+
+    # the fraction of the values of a feature which are assumed to satisfy
+    # each operator when planning, since only equality can be estimated
+    # from the statistics; 'indexed' is a string comparison narrowed down
+    # by features_fts, which should be searched first
+    selectivity = {
+        'indexed': 0.001,
+        '<': 0.25, '>': 0.25, '<=': 0.25, '>=': 0.25,
+        'contains': 0.1, 'startswith': 0.1, 'endswith': 0.1,
+        'matches': 0.1, 'imatches': 0.1, 'iequals': 0.01,
+    }
+
+    # the number of query templates to keep in `RBBLFile.query_cache`
+    cache_size = 128
+
     def __init__(self, db, type_map=None, feat_map=None):
         self.db = db
         self.type_map = type_map or {}
@@ -201,31 +368,61 @@ class Query:
         self.conditional = None
         self.features = {} # (uidx, name) => (fidx, ids, is_str)
         self.subqueries = [] # [(query, uidx, min, max), ...]
-        self.order = defaultdict(dict)
 
         self.select_cols = []
         self.select_tables = []
         self.where_conds = []
         self.params = []
         self.relation_count = 0
+        self.compiled = None
+        self.table_units = {} # table => {uidx, ...}
+        self.value_conds = [] # [(uidx, feature, value), ...]
+        self.filter_conds = [] # [(uidx, feature, selectivity key), ...]
+
+        self.flattened = False
+        self.counted = set()
+
+        self.limit = None
+        self.offset = None
+        self.sample = None
 
         self.results = []
         self.unit_ids = []
+        self.by_parent = {}
+
+        # set by instantiate()
+        self.template = None
+        self.values = []
+        self.source = None
 
     def add_clause(self, clause):
         txt, params = clause.toSQL()
         self.where_conds.append(txt)
         self.params += params
 
+    def changed_since(self, timestamp):
+        '''Only return matches in which at least one unit (not counting
+        subqueries) was modified after `timestamp`.'''
+        self.flatten()
+        conds = [f'julianday(TU{i}.modified) > julianday(?)'
+                 for i in range(len(self.units))]
+        self.where_conds.append('(' + ' OR '.join(conds) + ')')
+        self.params += [timestamp] * len(conds)
+        self.compiled = None
+
     def unit(self, utype, name):
+        self.detach()
         ret = Unit(self, utype, len(self.units), name)
         self.units.append(ret)
-        self.add(ret['meta:active'] == True)
         self.name2unit[name] = ret
         self.select_cols.append(f'TU{ret.index}.id AS U{ret.index}')
         self.select_tables.append(f'units TU{ret.index}')
+        self.table_units[f'units TU{ret.index}'] = {ret.index}
         self.add_clause(WhereClause(f'TU{ret.index}.type',
                                     utils.map_type(self.type_map, utype)))
+        # the unary + stops SQLite from treating this as a selective
+        # index constraint and starting the search from every unit
+        self.add_clause(WhereClause(f'+TU{ret.index}.active', True))
         return ret
 
     def __getitem__(self, key):
@@ -234,7 +431,9 @@ class Query:
         else:
             return self.name2unit[key]
 
-    def add_feature(self, idx, oldname, for_exist):
+    def lookup_feature(self, idx, oldname):
+        '''Return a list of `(id, valuetype)` pairs for the tiers that
+        feature `oldname` of unit `idx` refers to after mapping.'''
         oldtype = self.units[idx].type
         newtype = utils.map_type(self.type_map, oldtype)
         newname = utils.map_feature(self.feat_map, oldtype, oldname)
@@ -244,10 +443,15 @@ class Query:
             if oldtype != newtype or oldname != newname:
                 remap = f" (mapping to database type '{newtype}' and feature '{newname}')"
             raise ValueError(f"No feature '{oldname}' for unit type '{oldtype}{remap}.'")
+        return ids
+
+    def add_feature(self, idx, oldname, for_exist):
+        ids = self.lookup_feature(idx, oldname)
         is_str = any(x[1] == 'str' for x in ids)
         n = len(self.features)
         if not for_exist:
             self.select_tables.append(f'features F{n}')
+            self.table_units[f'features F{n}'] = {idx}
             self.where_conds.append(f'F{n}.unit = U{idx}')
             qs = ','.join(['?']*len(ids))
             self.where_conds.append(f'F{n}.feature IN ({qs})')
@@ -260,6 +464,7 @@ class Query:
         return self.features[(idx, name, for_exist)]
 
     def add(self, condition):
+        self.detach()
         if not isinstance(condition, Condition):
             raise ValueError(f'Constraint must be a Condition, not {condition.__type__.__name__}.')
         if self.conditional is None:
@@ -267,45 +472,337 @@ class Query:
         else:
             self.conditional = self.conditional & condition
 
+    def compile(self):
+        '''Return the SQL statement and parameters for the units and
+        conditions of this query (not including subqueries).'''
+        self.load_template(compile=True)
+        if self.compiled is None:
+            self.flatten()
+            self.add_subquery_counts()
+            cols = ", ".join(self.select_cols)
+            where = " AND ".join(self.where_conds)
+            paginate = self.paginate_in_sql()
+            if self.sample is not None and paginate:
+                # pick the sample first, then sort only those rows; every
+                # match is still visited (see set_sample())
+                sample = f'SELECT DISTINCT {cols} FROM {self.from_clause()} WHERE {where} ORDER BY random() LIMIT ?'
+                joins, join_params, order = self.compile_order(
+                    {u.index: f'S.U{u.index}' for u in self.units})
+                query = f'SELECT S.* FROM ({sample}) S{joins} ORDER BY {", ".join(order)}'
+                params = self.params + [self.sample] + join_params
+            else:
+                joins, join_params, order = self.compile_order()
+                query = f'SELECT DISTINCT {cols} FROM {self.from_clause()}{joins} WHERE {where} ORDER BY {", ".join(order)}'
+                params = join_params + self.params
+                if paginate and (self.limit is not None or self.offset):
+                    query += ' LIMIT ? OFFSET ?'
+                    # a negative limit means no limit
+                    params = params + [-1 if self.limit is None else self.limit,
+                                       self.offset or 0]
+            self.compiled = (query, params)
+        return self.compiled
+
+    def set_limit(self, limit=None, offset=None):
+        '''Return at most `limit` results (if not `None`), skipping
+        the first `offset`.'''
+        for name, val in [('limit', limit), ('offset', offset)]:
+            if val is not None and (not isinstance(val, int) or val < 0):
+                raise ValueError(f'Query {name} must be a non-negative integer.')
+        if self.sample is not None:
+            raise ValueError('Cannot combine sample with limit or offset.')
+        self.limit = limit
+        self.offset = offset
+        self.compiled = None
+
+    def set_sample(self, size):
+        '''Return `size` results chosen at random (or all of them, if
+        there are fewer). The sample is still sorted like any other
+        results.
+
+        This saves retrieving and sorting every result, but not finding
+        them: the sample is chosen with `ORDER BY random() LIMIT size`,
+        so every match is still produced and deduplicated before the
+        sample is picked, which takes about as long as a full search.'''
+        if not isinstance(size, int) or size < 0:
+            raise ValueError('Query sample must be a non-negative integer.')
+        if self.limit is not None or self.offset:
+            raise ValueError('Cannot combine sample with limit or offset.')
+        self.sample = size
+        self.compiled = None
+
+    def paginate_in_sql(self):
+        '''Whether `limit`, `offset`, and `sample` can be applied by
+        the SQL statement, which requires that every subquery which
+        could exclude a result has been checked by
+        `add_subquery_counts()`.'''
+        return all(i in self.counted or ((mn is None or mn <= 0) and mx is None)
+                   for i, (sub, idx, mn, mx) in enumerate(self.subqueries))
+
+    def paginate(self, results):
+        '''Apply `limit`, `offset`, and `sample` to `results` if
+        `compile()` was unable to.'''
+        if self.paginate_in_sql():
+            return results
+        if self.sample is not None:
+            results = list(results)
+            keep = random.sample(range(len(results)),
+                                 min(self.sample, len(results)))
+            return [results[i] for i in sorted(keep)]
+        if self.limit is None and not self.offset:
+            return results
+        start = self.offset or 0
+        stop = None if self.limit is None else start + self.limit
+        return itertools.islice(results, start, stop)
+
+    def flatten(self):
+        '''Add the tables and conditions needed by `self.conditional`
+        to the query, if this hasn't been done already.'''
+        self.load_template()
+        if self.conditional is not None and not self.flattened:
+            for c in self.conditional.flatten():
+                c.add_to_query(self)
+        self.flattened = True
+
+    def compile_unordered(self):
+        '''Return the SQL statement and parameters for the units and
+        conditions of this query without sorting, for use inside other
+        statements.'''
+        self.flatten()
+        self.add_subquery_counts()
+        query = f'SELECT DISTINCT {", ".join(self.select_cols)} FROM {self.from_clause()} WHERE {" AND ".join(self.where_conds)}'
+        return query, self.params
+
+    def add_subquery_counts(self):
+        '''Check the `min` and `max` of subqueries which don't have
+        subqueries of their own in SQL by grouping their matches by
+        parent, so that parents which can't satisfy them are never
+        returned.'''
+        for i, (sub, idx, mn, mx) in enumerate(self.subqueries):
+            if sub.subqueries or sub.results or i in self.counted:
+                continue
+            self.counted.add(i)
+            mn = mn if mn is not None and mn > 0 else None
+            if mn is None and mx is None:
+                continue
+            query, params = sub.compile_unordered()
+            if mn is not None:
+                having = ['COUNT(*) >= ?']
+                params = params + [mn]
+                if mx is not None:
+                    having.append('COUNT(*) <= ?')
+                    params.append(mx)
+                self.where_conds.append(f'U{idx} IN (SELECT U0 FROM ({query}) GROUP BY U0 HAVING {" AND ".join(having)})')
+            else:
+                self.where_conds.append(f'U{idx} NOT IN (SELECT U0 FROM ({query}) GROUP BY U0 HAVING COUNT(*) > ?)')
+                params = params + [mx]
+            self.params += params
+
+    def estimate_tables(self):
+        '''Return a dictionary mapping each table in `select_tables` to
+        the number of rows of it that are expected to match, according
+        to `self.db.stats`. Relations are not estimated.'''
+        stats = self.db.stats
+        est = {}
+        for i, u in enumerate(self.units):
+            est[f'units TU{i}'] = stats.count_units(
+                utils.map_type(self.type_map, u.type))
+        for (idx, name, for_exist), (n, ids, _, _) in self.features.items():
+            if not for_exist:
+                est[f'features F{n}'] = stats.count_tiers(ids)
+        for idx, name, value in self.value_conds:
+            n, ids, _, _ = self.get_feature(idx, name, False)
+            table = f'features F{n}'
+            est[table] = min(est[table], stats.count_value(ids, value))
+        for idx, name, op in self.filter_conds:
+            n, ids, _, _ = self.get_feature(idx, name, False)
+            table = f'features F{n}'
+            est[table] *= Query.selectivity[op]
+        return est
+
+    def from_clause(self):
+        '''Return the tables to select from. If the database has been
+        analyzed, the units which are expected to have the fewest matches
+        are searched first and the tables are joined with CROSS JOIN so
+        that SQLite keeps that order. Otherwise, SQLite chooses.'''
+        if not self.db.stats:
+            return ', '.join(self.select_tables)
+        est = self.estimate_tables()
+        by_unit = defaultdict(list)
+        relations = []
+        for table in self.select_tables:
+            if table.startswith(('relations ', 'ancestry ')):
+                relations.append(table)
+            else:
+                by_unit[min(self.table_units[table])].append(table)
+        for tables in by_unit.values():
+            tables.sort(key=lambda t: est[t])
+        unit_est = {i: est[tables[0]] for i, tables in by_unit.items()}
+
+        seq = []
+        placed = set()
+        remaining = set(range(len(self.units)))
+        while remaining:
+            linked = set()
+            for r in relations:
+                refs = self.table_units[r]
+                if refs & placed:
+                    linked.update(refs & remaining)
+            i = min(linked or remaining, key=lambda i: (unit_est[i], i))
+            placed.add(i)
+            remaining.remove(i)
+            for r in relations:
+                if r not in seq and self.table_units[r] <= placed:
+                    seq.append(r)
+            tables = by_unit[i]
+            if i not in linked and tables[0] != f'units TU{i}':
+                # start from the most selective feature
+                seq.append(tables[0])
+                tables = tables[1:]
+            seq.append(f'units TU{i}')
+            seq += [t for t in tables if t != f'units TU{i}']
+        return ' CROSS JOIN '.join(seq)
+
+    def compile_matches(self):
+        '''Return an SQL statement and parameters which select the
+        matches of this query (a column `U{i}` for each unit) in no
+        particular order, for use inside other statements. If some
+        subqueries can only be checked in Python, the statement lists
+        the results of `search()`.'''
+        if self.limit is None and not self.offset and self.sample is None:
+            query, params = self.compile_unordered()
+        else:
+            query, params = self.compile()
+        if self.paginate_in_sql():
+            return query, params
+        names = [u.name for u in self.units]
+        cols = ', '.join(f"json_extract(value, '$[{i}]') AS U{u.index}"
+                         for i, u in enumerate(self.units))
+        rows = [[r[n] for n in names] for r in self.search()]
+        return f'SELECT {cols} FROM json_each(?)', [json.dumps(rows)]
+
+    def aggregate(self, group_by=(), distinct=None, expressions=()):
+        '''Count the matches of this query for each combination of values
+        of the features in `group_by`, a list of `(unit name, feature)`
+        pairs. `expressions` are additional `(sql, params)` pairs to group
+        by, which can refer to the ID of each unit in a match as `M.U{i}`.
+        If `distinct` is the name of a unit, count the number of different
+        units it matched rather than the number of matches.
+
+        Return a list of `(values, count)` pairs, most frequent first.'''
+        def index(name):
+            if name not in self.name2unit:
+                raise ValueError(f'No unit named {name}.')
+            return self.name2unit[name].index
+        matches, params = self.compile_matches()
+        cols = []
+        col_params = []
+        types = []
+        joins = ''
+        join_params = []
+        for n, (name, feature) in enumerate(group_by):
+            idx = index(name)
+            ids = self.lookup_feature(idx, feature)
+            qs = ', '.join(['?']*len(ids))
+            joins += f' LEFT JOIN features G{n} ON G{n}.unit = M.U{idx} AND G{n}.feature IN ({qs})'
+            join_params += [x[0] for x in ids]
+            cols.append(f'G{n}.value')
+            vtypes = set(x[1] for x in ids)
+            types.append(vtypes.pop() if len(vtypes) == 1 else None)
+        for sql, p in expressions:
+            cols.append(sql)
+            col_params += p
+            types.append(None)
+        if distinct is None:
+            cols.append('COUNT(*)')
+        else:
+            cols.append(f'COUNT(DISTINCT M.U{index(distinct)})')
+        query = f'SELECT {", ".join(cols)} FROM ({matches}) M{joins}'
+        if len(cols) > 1:
+            query += f' GROUP BY {", ".join(str(i) for i in range(1, len(cols)))}'
+        order = [f'{len(cols)} DESC'] + [str(i) for i in range(1, len(cols))]
+        query += f' ORDER BY {", ".join(order)}'
+        self.db.cur.execute(query, col_params + params + join_params)
+        ret = []
+        for row in self.db.cur.fetchall():
+            values = tuple(v if t is None else self.db.interpret_value(v, t)
+                           for v, t in zip(row, types))
+            ret.append((values, row[-1]))
+        return ret
+
+    def count(self, distinct=None):
+        '''Return the number of matches of this query or, if `distinct`
+        is the name of a unit, the number of different units it matched.'''
+        return self.aggregate(distinct=distinct)[0][1]
+
+    def compile_order(self, id_exprs=None):
+        '''Return the joins, join parameters, and ORDER BY terms which
+        sort the results by the `order` feature of each unit (if any) and
+        then by ID. Units which lack a value for their `order` feature
+        come after those that have one, and units with the same value
+        are sorted by ID. `id_exprs` maps unit indexes to SQL expressions
+        for their IDs, if not `TU{i}.id`.'''
+        if id_exprs is None:
+            id_exprs = {u.index: f'TU{u.index}.id' for u in self.units}
+        joins = ''
+        params = []
+        order = []
+        for u in self.units:
+            if not u.order:
+                order.append(f'U{u.index}')
+                continue
+            ids = self.lookup_feature(u.index, u.order)
+            if len(set(x[1] for x in ids)) > 1:
+                raise ValueError(f"Cannot sort unit '{u.name}' by feature '{u.order}' because it has multiple types after mapping.")
+            qs = ', '.join(['?']*len(ids))
+            joins += f' LEFT JOIN features O{u.index} ON O{u.index}.unit = {id_exprs[u.index]} AND O{u.index}.feature IN ({qs})'
+            params += [x[0] for x in ids]
+            order += [f'O{u.index}.value IS NULL',
+                      f'COALESCE(O{u.index}.value, U{u.index})',
+                      f'U{u.index}']
+        return joins, params, order
+
     def prepare_search(self, parent_ids=None):
         if self.results:
             return
+        self.load_template(compile=not parent_ids)
         if parent_ids:
             self.add_clause(WhereClause('U0', parent_ids))
-        if self.conditional is not None:
-            for c in self.conditional.flatten():
-                c.add_to_query(self)
-        query = f'SELECT {", ".join(self.select_cols)} FROM {", ".join(self.select_tables)} WHERE {" AND ".join(self.where_conds)}'
-        self.db.cur.execute(query, self.params)
-        self.results = list(set(self.db.cur.fetchall()))
+        query, params = self.compile()
+        if self.sample is None:
+            self.results = self.db.fetch_cached(query, params)
+        else:
+            # caching a random sample would make it the same every time
+            self.db.cur.execute(query, params)
+            self.results = self.db.cur.fetchall()
 
         self.unit_ids = [set() for i in range(len(self.units))]
         for r in self.results:
             for i in range(len(self.units)):
                 self.unit_ids[i].add(r[i])
 
-        for i, u in enumerate(self.units):
-            if u.order:
-                _, ids, types, _ = self.get_feature(i, u.order, False)
-                if len(types) > 1:
-                    raise ValueError(f"Cannot sort unit '{u.name}' by feature '{u.order}' because it has multiple types after mapping.")
-                t = list(types)[0]
-                self.db.execute_clauses(
-                    'SELECT unit, value FROM features',
-                    WhereClause('feature', ids),
-                    WhereClause('unit', list(self.unit_ids[i])))
-                self.order[i] = {u: (0, self.db.interpret_value(v, t))
-                                 for u, v in self.db.cur.fetchall()}
-
-        self.results.sort(
-            key=lambda tup: tuple([self.order[i].get(u, (1, u))
-                                   for i, u in enumerate(tup)]))
+        if parent_ids is not None:
+            self.by_parent = defaultdict(list)
+            for r in self.results:
+                self.by_parent[r[0]].append(r)
+
+    def prepare_subqueries(self):
+        '''Run all subqueries (recursively) restricted to the units
+        matched by this query. Return False if some subquery requires
+        matches but has none.'''
+        for sub, idx, mn, mx in self.subqueries:
+            sub.prepare_search(list(self.unit_ids[idx]))
+            if mn is not None and mn > 0 and not sub.results:
+                return False
+            if not sub.prepare_subqueries():
+                return False
+        return True
 
     def get_results(self, parent=None):
         names = [u.name for u in self.units]
-        for result in self.results:
-            if parent is not None and result[0] != parent:
-                continue
+        rows = self.results
+        if parent is not None:
+            rows = self.by_parent.get(parent, [])
+        for result in rows:
             dct = dict(zip(names, result))
             count = Counter()
             ok = True
@@ -323,13 +820,59 @@ class Query:
             if ok:
                 yield dct
 
-    def search(self):
+    def can_stream(self):
+        return not self.subqueries
+
+    def stream(self, batch_size=1000, snapshot=False, prefetch_types=False):
+        '''Like `search()`, but fetch results from the database
+        `batch_size` at a time rather than loading them all into Python.
+
+        This bounds the memory used by Python, but not by SQLite: results
+        are deduplicated and sorted, so SQLite may still build a temporary
+        B-tree of every match before returning the first one, and with
+        `temp_store=MEMORY` (as in the `read-mostly` and `bulk-import`
+        profiles) that B-tree is kept in memory.
+
+        If `snapshot` is true, the results are first copied into
+        a temporary table, so that the database can safely be modified
+        while iterating over them.
+
+        Queries with subqueries can't be streamed and will fall back
+        to `search()`.'''
+        if not self.can_stream() or (self.db.result_cache and not snapshot):
+            yield from self.search(prefetch_types=prefetch_types)
+            return
+        query, params = self.compile()
+        cur = self.db.con.cursor()
+        table = None
+        if snapshot:
+            table = f'snapshot_{id(self)}'
+            cur.execute(f'CREATE TEMP TABLE {table} AS {query}', params)
+            query = f'SELECT * FROM temp.{table} ORDER BY rowid'
+            params = []
+        try:
+            cur.execute(query, params)
+            names = [u.name for u in self.units]
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                if prefetch_types:
+                    self.db.prefetch_unit_types(
+                        sorted(set(u for r in rows for u in r)))
+                for r in rows:
+                    yield dict(zip(names, r))
+        finally:
+            cur.close()
+            if table:
+                self.db.cur.execute(f'DROP TABLE IF EXISTS temp.{table}')
+
+    def search(self, prefetch_types=False):
         self.prepare_search()
-        for sub, idx, mn, mx in self.subqueries:
-            sub.prepare_search(list(self.unit_ids[idx]))
-            if mn is not None and mn > 0 and not sub.results:
-                return
-        yield from self.get_results()
+        if prefetch_types:
+            self.db.prefetch_unit_types(sorted(set().union(*self.unit_ids)))
+        if self.prepare_subqueries():
+            yield from self.paginate(self.get_results())
 
     def add_line(self, line, linenumber=0):
         prefix = ''
@@ -347,12 +890,25 @@ class Query:
                 raise ValueError(prefix+'Missing unit type.')
             self.unit(tokens[2:], tokens[1])
             return
+        keyword = tokens[0].lower()
+        if keyword in ['limit', 'offset', 'sample'] and len(tokens) == 2:
+            if not tokens[1].isdigit():
+                raise ValueError(prefix+f'Expected a number after {keyword}.')
+            if keyword == 'sample':
+                self.set_sample(int(tokens[1]))
+            elif keyword == 'limit':
+                self.set_limit(int(tokens[1]), self.offset)
+            else:
+                self.set_limit(self.limit, int(tokens[1]))
+            return
         precedence = {
             '.': 7, 'has': 7, 'exists': 7, 'feature': 7,
             '*': 6, '/': 6, '%': 6,
             '+': 5, '-': 5,
-            'contains': 4, 'startswith': 4, 'endswith': 4, 'parent': 4, 'child': 4,
-            '<': 3, '>': 3, '<=': 3, '>=': 3, '=': 3, '!=': 3,
+            'contains': 4, 'startswith': 4, 'endswith': 4,
+            'matches': 4, 'imatches': 4,
+            'parent': 4, 'child': 4, 'ancestor': 4, 'descendant': 4,
+            '<': 3, '>': 3, '<=': 3, '>=': 3, '=': 3, '!=': 3, 'iequals': 3,
             'not': 2, 'NOT': 2,
             'and': 1, 'AND': 1,
             'or': 0, 'OR': 0,
@@ -392,7 +948,7 @@ class Query:
                     raise ValueError(prefix+'Unexpected NOT.')
             elif ltok in precedence:
                 op = op_rename.get(ltok, ltok)
-                if op in ['feature', 'parent', 'child']:
+                if op in ['feature', 'parent', 'child', 'ancestor', 'descendant']:
                     if not stack:
                         pass
                     elif isinstance(stack[-1], Unit):
@@ -430,7 +986,7 @@ class Query:
                     for u in self.units:
                         if u.name == val:
                             val = u
-                            if stack and isinstance(stack[-1], Condition) and stack[-1].operator in ['parent', 'child']:
+                            if stack and isinstance(stack[-1], Condition) and stack[-1].operator in ['parent', 'child', 'ancestor', 'descendant']:
                                 val = u.index
                             break
                     else:
@@ -455,7 +1011,7 @@ class Query:
         done = set(order or [])
         seq = [k for k in order or [] if k in query]
         seq += [k for k in sorted(query.keys()) if k not in done]
-        units = {}
+        units = []
         for key in seq:
             pattern = query[key]
             if not isinstance(pattern, dict):
@@ -463,13 +1019,15 @@ class Query:
             if 'type' not in pattern:
                 raise ValueError(f'Missing unit type for {key}.')
             self.unit(pattern['type'], key)
-        for key in seq:
+            units.append(key)
+        for key in units:
             self.parse_unit_dict(query[key], self.name2unit[key])
 
     def parse_unit_dict(self, pattern, unit):
         op_lookup = {'lt': '<', 'lte': '<=', 'gt': '>', 'gte': '>=', '=': '=',
                      'startswith': 'startswith', 'endswith': 'endswith',
-                     'contains': 'contains'}
+                     'contains': 'contains', 'matches': 'matches',
+                     'imatches': 'imatches', 'iequals': 'iequals'}
         for spec in pattern.get('features', []):
             if isinstance(spec, str):
                 spec = spec.strip()
@@ -519,6 +1077,11 @@ class Query:
             if parent not in self.name2unit:
                 raise ValueError(f'No node named {parent} (refereced by {unit.name}).')
             self.add(unit.parent(self.name2unit[parent]))
+        ancestor = pattern.get('ancestor')
+        if ancestor:
+            if ancestor not in self.name2unit:
+                raise ValueError(f'No node named {ancestor} (refereced by {unit.name}).')
+            self.add(unit.ancestor(self.name2unit[ancestor]))
         next = pattern.get('next')
         if next:
             if next not in self.name2unit:
@@ -537,23 +1100,173 @@ class Query:
             Q, _ = unit.subquery(min=mn, max=mx)
             Q.parse_query_dict(sq)
 
-    @staticmethod
-    def parse_query(db, query, order=None, type_map=None, feat_map=None):
-        if isinstance(query, Query):
-            return query
-        Q = Query(db, type_map, feat_map)
+    def parse(self, query, order=None):
         if isinstance(query, dict):
-            Q.parse_query_dict(query, order)
+            self.parse_query_dict(query, order)
+            # only the top level of the query can be limited
+            keys = [k for k in ['limit', 'offset']
+                    if not isinstance(query.get(k), (dict, type(None)))]
+            if keys:
+                self.set_limit(query.get('limit'), query.get('offset'))
+            if not isinstance(query.get('sample'), (dict, type(None))):
+                self.set_sample(query['sample'])
         elif isinstance(query, str):
             for linenumber, line in enumerate(query.splitlines(), 1):
-                Q.add_line(line, linenumber=linenumber)
+                self.add_line(line, linenumber=linenumber)
         else:
             raise ValueError(f'Query must be dictionary or string, not {query.__type__.__name__}.')
-        return Q
 
-def search(db, query, order=None):
+    def instantiate(self, values, source=None):
+        '''Return a new query which will use the parsed and compiled
+        state of this one (a template), with each `Slot` replaced by the
+        corresponding item of `values`.'''
+        if self.conditional is not None:
+            for i in self.conditional.pattern_slots():
+                compile_pattern(values[i])
+        ret = Query(self.db, self.type_map, self.feat_map)
+        ret.template = self
+        ret.values = values
+        ret.source = source
+        ret.units = [replace(u, query=ret) for u in self.units]
+        ret.name2unit = {u.name: u for u in ret.units}
+        ret.conditional = self.conditional
+        ret.subqueries = [(sub.instantiate(values), idx, mn, mx)
+                          for sub, idx, mn, mx in self.subqueries]
+        ret.limit = self.limit
+        ret.offset = self.offset
+        ret.sample = self.sample
+        return ret
+
+    def load_template(self, compile=False):
+        '''Copy the compiled state of `self.template`, if any. If
+        `compile` is false, the SQL statement itself is left to be built
+        by `compile()`, so that more clauses can be added first. It is
+        also rebuilt if it would differ from the template's, because the
+        limit, offset, or sample have changed or because the join order
+        depends on the values filled in.'''
+        T = self.template
+        if T is None:
+            return
+        self.template = None
+        try:
+            T.flatten()
+            T.add_subquery_counts()
+            reuse = (compile and not T.plan_uses_slots()
+                     and (self.limit, self.offset, self.sample) ==
+                         (T.limit, T.offset, T.sample))
+            if reuse:
+                T.compile()
+        except Exception:
+            # the template may now be partially flattened
+            self.db.query_cache.pop(T.cache_key, None)
+            raise
+        def fill(params):
+            return [self.values[p.index] if isinstance(p, Slot) else p
+                    for p in params]
+        self.select_cols = list(T.select_cols)
+        self.select_tables = list(T.select_tables)
+        self.where_conds = list(T.where_conds)
+        self.params = fill(T.params)
+        self.relation_count = T.relation_count
+        self.features = dict(T.features)
+        self.table_units = dict(T.table_units)
+        self.value_conds = [(i, f, fill([v])[0]) for i, f, v in T.value_conds]
+        self.filter_conds = list(T.filter_conds)
+        self.flattened = True
+        self.counted = set(T.counted)
+        if reuse:
+            sql, params = T.compiled
+            self.compiled = (sql, fill(params))
+
+    def plan_uses_slots(self):
+        '''Whether `from_clause()` would estimate the size of some table
+        from a `Slot` rather than an actual value.'''
+        return bool(self.db.stats) and any(
+            isinstance(v, Slot) for _, _, v in self.value_conds)
+
+    def detach(self):
+        '''Replace the template which this query was created from with
+        a fresh parse of the original query, so that it can be modified.'''
+        if self.template is None:
+            return
+        if self.source is None:
+            raise ValueError('Cannot modify a cached subquery.')
+        fresh = Query(self.db, self.type_map, self.feat_map)
+        fresh.parse(*self.source)
+        limits = (self.limit, self.offset, self.sample)
+        self.__dict__.update(fresh.__dict__)
+        self.limit, self.offset, self.sample = limits
+        for u in self.units:
+            u.query = self
+
+    def set_cache_key(self, key):
+        self.cache_key = key
+        for sub, _, _, _ in self.subqueries:
+            sub.set_cache_key(key)
+
+    @staticmethod
+    def parse_query(db, query, order=None, type_map=None, feat_map=None):
+        if isinstance(query, Query):
+            return query
+        found = template_key(query, order, type_map, feat_map)
+        if found is None:
+            Q = Query(db, type_map, feat_map)
+            Q.parse(query, order)
+            return Q
+        key, values, template = found
+        # plans depend on the tiers and statistics that were loaded
+        generation = (db.catalog.generation, db.stats.generation)
+        cached = db.query_cache.get(key)
+        if cached is not None and cached[0] == generation:
+            db.query_cache.move_to_end(key)
+            T = cached[1]
+        else:
+            T = Query(db, type_map, feat_map)
+            T.parse(template, order)
+            T.set_cache_key(key)
+            db.query_cache[key] = (generation, T)
+            while len(db.query_cache) > Query.cache_size:
+                db.query_cache.popitem(last=False)
+        return T.instantiate(values, (query, order))
+
+def search(db, query, order=None, prefetch_types=False, stream=False,
+           snapshot=False, since=None, limit=None, offset=None, sample=None):
+    Q = Query.parse_query(db, query, order)
+    if limit is not None or offset is not None:
+        Q.set_limit(limit, offset)
+    if sample is not None:
+        Q.set_sample(sample)
+    if since is not None:
+        Q.changed_since(since)
+    if stream:
+        yield from Q.stream(snapshot=snapshot, prefetch_types=prefetch_types)
+    else:
+        yield from Q.search(prefetch_types=prefetch_types)
+
+def search_changes(db, query, since, previous=(), order=None):
+    '''Re-run `query`, given the results of a run at time `since`.
+    Return a pair of lists: the current matches which involve at least
+    one unit modified after `since`, and the members of `previous` which
+    involve such a unit and should therefore be discarded (they may or
+    may not reappear in the first list). As with `since`, units matched
+    by subqueries are not checked.'''
+    def top_level(match):
+        # subquery results are keyed by (unit name, number)
+        return [u for k, u in match.items() if not isinstance(k, tuple)]
     Q = Query.parse_query(db, query, order)
-    yield from Q.search()
+    Q.changed_since(since)
+    added = list(Q.search())
+    ids = set()
+    for match in previous:
+        ids.update(top_level(match))
+    changed = set()
+    if ids:
+        db.cur.execute(
+            'SELECT id FROM units WHERE julianday(modified) > julianday(?) AND id IN (SELECT value FROM json_each(?))',
+            (since, json.dumps(sorted(ids))))
+        changed = set(u for (u,) in db.cur.fetchall())
+    retracted = [m for m in previous if changed.intersection(top_level(m))]
+    return added, retracted
 
 class ResultTable:
     # TODO: subquery support
@@ -564,7 +1277,7 @@ class ResultTable:
         self.feat_map = feat_map or {}
         self.rev_feat_map = {v:k for k, v in self.feat_map.items()}
         Q = Query.parse_query(db, query, order, self.rev_type_map, self.rev_feat_map)
-        self.nodes = list(Q.search())
+        self.nodes = list(Q.search(prefetch_types=True))
         self.features = []
         self.feature_names = {}
         for result in self.nodes:
@@ -613,13 +1326,12 @@ class ResultTable:
         for f in features:
             if isinstance(f, int):
                 feats.append(f)
-                t = self.db.first_clauses('SELECT valuetype FROM tiers',
-                                          WhereClause('id', f))
+                t = self.db.catalog.get_by_id(f)
                 if t is None:
                     if error:
                         raise ValueError(f'No feature with id {f}.')
                 else:
-                    feat_types[f] = t[0]
+                    feat_types[f] = t[2]
             else:
                 if map_features:
                     for (fi, ti), (fo, to) in self.feat_map.items():
@@ -630,22 +1342,19 @@ class ResultTable:
                             continue
                         f = fi
                         break
-                self.db.execute_clauses('SELECT id, valuetype FROM tiers',
-                                        WhereClause('name', f),
-                                        WhereClause('unittype', types))
                 found_any = not error
-                for i, t in self.db.cur.fetchall():
+                for i, t in self.db.get_feature_multi_type(types, f):
                     found_any = True
                     feats.append(i)
                     feat_types[i] = t
                     self.feature_names[i] = f
                 if not found_any:
                     raise ValueError(f'Feature {f} does not exist for unit type {types}.')
-        units = list(set(self._node_ids(node)))
-        self.db.execute_clauses('SELECT unit, feature, value FROM features',
-                                WhereClause('unit', units),
-                                WhereClause('feature', feats))
-        for u, f, v in self.db.cur.fetchall():
+        units = sorted(set(self._node_ids(node)))
+        rows = self.db.fetch_clauses('SELECT unit, feature, value FROM features',
+                                     WhereClause('unit', units),
+                                     WhereClause('feature', feats))
+        for u, f, v in rows:
             v = self.db.interpret_value(v, feat_types[f])
             for rid in self.unit2results[u]:
                 if u in utils.as_list(self.nodes[rid][node]):
@@ -658,12 +1367,10 @@ class ResultTable:
             if ti and ti not in self.types[node]:
                 continue
             if fo.startswith(tier+':'):
-                f = self.db.first_clauses('SELECT id FROM tiers',
-                                          WhereClause('name', fi),
-                                          WhereClause('unittype', self.types[node]))
+                f = self.db.get_feature_multi_type(self.types[node], fi)
                 if f:
-                    feats.append(f[0])
-                    self.feature_names[f[0]] = fo
+                    feats.append(f[0][0])
+                    self.feature_names[f[0][0]] = fo
             if fi.startswith(tier+':'):
                 skip.add(fi)
         self.db.execute_clauses('SELECT id, name FROM tiers',
@@ -679,7 +1386,7 @@ class ResultTable:
     def add_children(self, node, child_type):
         if not self.nodes:
             return
-        units = list(set(self._node_ids(node)))
+        units = sorted(set(self._node_ids(node)))
         children = self.db.get_children(units, child_type)
         name = node + '_children'
         while name in self.nodes[0]:
@@ -11,10 +11,32 @@ ALL_READERS = {}
 class ReaderError(Exception):
     pass
 
+def parse_file(mode, user, conf, kwargs, mappings, pth):
+    '''Parse `pth` with a new reader of type `mode` and return the result
+    of `Reader.parse()`. This is run in worker processes by the import
+    process, which then writes the blocks with `Reader.write_blocks()`.'''
+    if mode not in ALL_READERS:
+        # worker processes which weren't forked need to load them again
+        from rebabel_format import load_readers
+        load_readers(True)
+    reader = ALL_READERS[mode](None, user, conf, kwargs)
+    reader.set_mappings(*mappings)
+    return reader.parse(pth)
+
+class BlockIndex(int):
+    '''A feature value set by `Reader.set_block_index()` while parsing
+    a file separately from writing it, which counts the blocks parsed
+    before it in that file and is corrected by `Reader.write_blocks()`
+    to count the blocks actually written.'''
+
 class Reader:
     identifier = None
     parameters = {}
 
+    # whether a block which fails to be written should be skipped
+    # rather than ending the import of the file
+    skip_failed_blocks = False
+
     merge_on = Parameter(required=False, type=dict)
 
     def __init__(self, db, user, conf, kwargs):
@@ -39,6 +61,9 @@ class Reader:
 
         self.block_count = 0
 
+        # see parse()
+        self.blocks = None
+
         self.type_map = {}
         self.feature_map = {}
 
@@ -95,21 +120,47 @@ class Reader:
         if ftype == 'ref':
             self._check_name(value)
         else:
-            self.db.check_type(ftype, value)
+            RBBLFile.check_type(ftype, value)
         self.features[unit_name][(feature, ftype)] = (value, confidence)
 
+    def set_block_index(self, unit_name, feature='meta:index', start=1):
+        '''Set the integer feature `feature` of `unit_name` to the number
+        of the current block among all those read by this reader,
+        counting from `start`.'''
+        value = self.block_count + start
+        if self.blocks is not None:
+            # the blocks of earlier files are only known when writing
+            value = BlockIndex(value)
+        self.set_feature(unit_name, feature, 'int', value)
+
+    def _remap_feature(self, feature, unittype):
+        m_key = (feature, unittype)
+        n_key = (feature, None)
+        return self.feature_map.get(m_key, self.feature_map.get(n_key, feature))
+
     def _remap_features(self):
         new_feats = defaultdict(dict)
         for name, dct in self.features.items():
             for (feature, ftype), val in dct.items():
-                m_key = (feature, self.types.get(name))
-                n_key = (feature, None)
-                feature = self.feature_map.get(m_key,
-                                               self.feature_map.get(n_key, feature))
+                feature = self._remap_feature(feature, self.types.get(name))
                 new_feats[name][(feature, ftype)] = val
         self.features = new_feats
 
     def finish_block(self, parent_if_missing=None, keep_uids=False):
+        if self.blocks is not None:
+            if parent_if_missing is not None:
+                self.error('Blocks with a missing parent cannot be parsed separately from writing them.')
+            types = {n: self.types[n] for n in self.id_seq if n in self.types}
+            self.blocks.append(
+                (self.location, self.id_seq, types, self.parents,
+                 self.relations, self.features, keep_uids,
+                 self.block_count))
+            self.parents = {}
+            self.relations = defaultdict(set)
+            self.features = defaultdict(dict)
+            self.reset_block(keep_uids, self.uids)
+            return
+
         parent_type_if_missing = None
         if parent_if_missing is not None:
             parent_type_if_missing = self.db.get_unit_type(parent_if_missing)
@@ -127,7 +178,7 @@ class Reader:
             merge_values = {k: defaultdict(list) for k in self.merge_on}
             for name in self.id_seq:
                 typ = self.types.get(name)
-                if typ in merge_values:
+                if typ in merge_values and name not in self.uids:
                     for feat, val in self.features[name].items():
                         if feat[0] == self.merge_on[typ]:
                             merge_values[typ][val[0]].append(name)
@@ -159,10 +210,15 @@ class Reader:
                 all_merge += merge_possible[name]
                 if name not in self.parents:
                     continue
-                if self.parents[name] not in merge_possible:
-                    # TODO: what is parent is in self.uids?
+                parent = self.parents[name]
+                if parent in self.uids:
+                    # the parent was written in an earlier block,
+                    # so it only has one possibility
+                    merge_possible[parent] = [self.uids[parent]]
+                    all_merge.append(self.uids[parent])
+                elif parent not in merge_possible:
                     del merge_possible[name]
-                child_names[self.parents[name]].append(name)
+                child_names[parent].append(name)
             self.db.execute_clauses('SELECT parent, child FROM relations',
                                     WhereClause('child', all_merge),
                                     WhereClause('parent', all_merge),
@@ -194,24 +250,52 @@ class Reader:
                     uids[name] = ids[0]
                     is_merged.add(name)
 
+        new_names = []
         for name in self.id_seq:
             if name in uids:
+                if name in self.uids:
+                    # kept from an earlier block, so any features
+                    # need to be updated rather than inserted
+                    is_merged.add(name)
                 continue
             if name not in self.types:
                 self.error(f"Unit '{name}' has not been assigned a type.")
-            uids[name] = self.db.create_unit(self.types[name], user=self.user)
+            new_names.append(name)
 
+        # check the features before writing anything so that any
+        # errors leave the database unchanged, but only create them
+        # once the block is being written
+        feature_ids = {}
+        value_types = {}
+        for name in self.id_seq:
+            typ = self.types[name]
+            for feature, ftype in self.features[name]:
+                key = (feature, ftype, typ)
+                if key in feature_ids:
+                    continue
+                if value_types.setdefault((feature, typ), ftype) != ftype:
+                    self.error(f'Feature {feature} for {typ} is used with value types {value_types[(feature, typ)]} and {ftype}.')
+                feature_ids[key] = self.check_feature(typ, feature, ftype)
+
+        new_ids = self.db.create_units_many(
+            [self.types[name] for name in new_names], user=self.user)
+        uids.update(zip(new_names, new_ids))
+
+        now = self.db.now()
         parents = []
         for name in self.id_seq:
             parent_name = self.parents.get(name)
-            parent = uids.get(parent_name, parent_if_missing)
+            if name in self.uids:
+                parent = uids.get(parent_name)
+            else:
+                parent = uids.get(parent_name, parent_if_missing)
             if parent is None:
                 continue
             parent_type = self.types.get(parent_name, parent_type_if_missing)
             parents.append(
                 {'parent': parent, 'parent_type': parent_type,
                  'child': uids[name], 'child_type': self.types[name],
-                 'isprimary': True, 'active': True, 'date': self.db.now()}
+                 'isprimary': True, 'active': True, 'date': now}
             )
             for rname in sorted(self.relations[name]):
                 rid = uids[rname]
@@ -219,40 +303,40 @@ class Reader:
                 parents.append(
                     {'parent': rid, 'parent_type': rtype,
                      'child': uids[name], 'child_type': self.types[name],
-                     'isprimary': False, 'active': True, 'date': self.db.now()}
+                     'isprimary': False, 'active': True, 'date': now}
                 )
         self.db.cur.executemany(
             'INSERT OR IGNORE INTO relations(parent, parent_type, child, child_type, isprimary, active, date) VALUES(:parent, :parent_type, :child, :child_type, :isprimary, :active, :date)',
             parents,
         )
+        self.db.update_ancestry([p['child'] for p in parents if p['isprimary']])
         self.parents = {}
         self.relations = defaultdict(set)
 
-        feature_ids = {}
+        # (unit, feature, value, user, date, confidence)
         features = []
         merge_features = []
         for name in self.id_seq:
+            uid = uids[name]
+            typ = self.types.get(name)
+            merged = name in is_merged
             for (feature, ftype), (value, conf) in self.features[name].items():
-                key = (feature, ftype, self.types[name])
-                if key in feature_ids:
-                    fid = feature_ids[key]
-                else:
-                    fid = self.ensure_feature(self.types[name], feature, ftype)
-                    feature_ids[key] = fid
+                fid = feature_ids[(feature, ftype, typ)]
+                if fid is None:
+                    fid = self.ensure_feature(typ, feature, ftype)
+                    feature_ids[(feature, ftype, typ)] = fid
                 if ftype == 'ref':
                     value = uids[value]
-                dct = {
-                    'unit': uids[name], 'feature': fid, 'value': value,
-                    'user': self.user, 'date': self.db.now(),
-                    'confidence': conf,
-                }
-                if name in is_merged:
-                    merge_features.append(dct)
+                if merged:
+                    merge_features.append({
+                        'unit': uid, 'feature': fid, 'value': value,
+                        'user': self.user, 'date': now, 'confidence': conf,
+                    })
                 else:
-                    features.append(dct)
+                    features.append((uid, fid, value, self.user, now, conf))
         if features:
             self.db.cur.executemany(
-                'INSERT INTO features(unit, feature, value, user, date, confidence) VALUES(:unit, :feature, :value, :user, :date, :confidence)',
+                'INSERT INTO features(unit, feature, value, user, date, confidence) VALUES(?, ?, ?, ?, ?, ?)',
                 features,
             )
         if merge_features:
@@ -265,16 +349,32 @@ class Reader:
                 merge_features,
             )
         self.features = defaultdict(dict)
-
+        # new units are already marked as modified, but existing ones
+        # which gained features or children are not
+        touched = set(uids[name] for name in is_merged)
+        if parent_if_missing is not None and parents:
+            touched.add(parent_if_missing)
+        self.db.touch_units(sorted(touched))
+        self.reset_block(keep_uids, uids)
+
+    def reset_block(self, keep_uids, uids):
         self.id_seq = []
-        if keep_uids:
+        self.all_ids = set()
+        if keep_uids is True:
             self.uids = uids
+        elif keep_uids:
+            self.uids = {n: uids[n] for n in keep_uids if n in uids}
+            self.types = {n: self.types[n] for n in keep_uids
+                          if n in self.types}
         else:
-            self.all_ids = set()
+            self.uids = {}
             self.types = {}
         self.block_count += 1
 
-    def ensure_feature(self, unittype, feature, valuetype):
+    def check_feature(self, unittype, feature, valuetype):
+        '''Return the ID of `feature` for `unittype`, or `None` if it
+        doesn't exist yet, reporting an error if it exists with a value
+        type other than `valuetype`.'''
         key = (unittype, feature)
         if key in self.known_feats:
             return self.known_feats[key]
@@ -284,13 +384,19 @@ class Reader:
             return fid
         elif typ is not None:
             self.error(f'Feature {feature} for {unittype} already exists with value type {typ}.')
-        else:
+        return None
+
+    def ensure_feature(self, unittype, feature, valuetype):
+        fid = self.check_feature(unittype, feature, valuetype)
+        if fid is None:
             self.db.create_feature(unittype, feature, valuetype)
             fid, typ = self.db.get_feature(unittype, feature, error=False)
-            self.known_feats[key] = fid
-            return fid
+            self.known_feats[(unittype, feature)] = fid
+        return fid
 
     def create_unit(self, unittype, parent=None):
+        if self.blocks is not None:
+            self.error('Units cannot be created while parsing separately from writing.')
         uid = self.db.create_unit_with_features(unittype, [], self.user,
                                                 parent=parent)
         return uid
@@ -305,6 +411,8 @@ class Reader:
         fin.close()
 
     def commit(self):
+        if self.blocks is not None:
+            return
         self.db.committing = True
         self.db.commit()
         self.db.committing = False
@@ -316,6 +424,47 @@ class Reader:
             self.read_file(fin)
             self.close_file(fin)
 
+    def parse(self, pth):
+        '''Read `pth` without writing anything to the database (which
+        may be `None`). Return `(blocks, ok)`, where `blocks` is a list
+        of the blocks which `finish_block()` would have written and `ok`
+        is false if parsing stopped early because of an error.'''
+        self.blocks = []
+        self.block_count = 0
+        self.filename = pth
+        ok = True
+        try:
+            fin = self.open_file(pth)
+            self.read_file(fin)
+            self.close_file(fin)
+        except ReaderError:
+            ok = False
+        blocks = self.blocks
+        self.blocks = None
+        return blocks, ok
+
+    def write_blocks(self, pth, blocks):
+        '''Write blocks returned by `parse()` to the database. The result
+        is the same as if `pth` had been read by this reader.'''
+        with self.db.transaction():
+            self.filename = pth
+            for (self.location, self.id_seq, types, self.parents,
+                 self.relations, self.features, keep_uids,
+                 parsed) in blocks:
+                # blocks which fail to be written aren't counted,
+                # so the index may be lower than it was when parsing
+                offset = self.block_count - parsed
+                for feats in self.features.values():
+                    for key, (value, conf) in feats.items():
+                        if isinstance(value, BlockIndex):
+                            feats[key] = (int(value) + offset, conf)
+                self.types.update(types)
+                try:
+                    self.finish_block(keep_uids=keep_uids)
+                except ReaderError:
+                    if not self.skip_failed_blocks:
+                        raise
+
     @classmethod
     def help_text(cls):
         if not hasattr(cls, 'identifier'):
@@ -342,6 +491,36 @@ class XMLReader(Reader):
     def close_file(self, fin):
         pass
 
+class StreamingXMLReader(Reader):
+    # tags of the elements to pass to read_element(); None for all
+    element_tags = None
+
+    def open_file(self, pth):
+        return open(pth, 'rb')
+
+    def start_element(self, elem):
+        pass
+
+    def read_element(self, elem):
+        pass
+
+    def read_file(self, fin):
+        import xml.etree.ElementTree as ET
+        open_elements = []
+        for event, elem in ET.iterparse(fin, events=('start', 'end')):
+            if event == 'start':
+                self.start_element(elem)
+                open_elements.append(elem)
+                continue
+            open_elements.pop()
+            if self.element_tags is None or elem.tag in self.element_tags:
+                self.read_element(elem)
+                # discard the subtree so that memory use doesn't depend
+                # on the size of the file
+                elem.clear()
+                if open_elements:
+                    open_elements[-1].remove(elem)
+
 class JSONReader(Reader):
     def open_file(self, pth):
         import json
@@ -354,6 +533,7 @@ class JSONReader(Reader):
 class LineReader(Reader):
     block_name = 'sentence'
     include_boundaries = False
+    skip_failed_blocks = True
 
     def is_boundary(self, line):
         return not line
@@ -365,11 +545,19 @@ class LineReader(Reader):
         try:
             self.finish_block()
         except ReaderError:
-            pass
+            self.discard_block()
 
     def process_line(self, line):
         pass
 
+    def discard_block(self):
+        self.id_seq = []
+        self.all_ids = set()
+        self.types = {}
+        self.parents = {}
+        self.relations = defaultdict(set)
+        self.features = defaultdict(dict)
+
     def read_file(self, fin):
         self.reset()
         block_error = False
@@ -302,42 +302,30 @@ class QueryParseTrees(SimpleTest, unittest.TestCase):
         ('basic',
          '''unit N word
          N.ud:lemma = "hi"''',
-         ('AND',
-          ('=', ('feature', 0, 'meta:active'), True),
-          ('=', ('feature', 0, 'ud:lemma'), "hi"))),
+         ('=', ('feature', 0, 'ud:lemma'), "hi")),
         ('boolean',
          '''unit N word
          N.ud:null = false''',
-         ('AND',
-          ('=', ('feature', 0, 'meta:active'), True),
-          ('=', ('feature', 0, 'ud:null'), False))),
+         ('=', ('feature', 0, 'ud:null'), False)),
         ('precedence 1',
          '''unit N word
          N.ud:lemma + "ing" = N.ud:form''',
-         ('AND',
-          ('=', ('feature', 0, 'meta:active'), True),
-          ('=',
-           ('+', ('feature', 0, 'ud:lemma'), "ing"),
-           ('feature', 0, 'ud:form')))),
+         ('=',
+          ('+', ('feature', 0, 'ud:lemma'), "ing"),
+          ('feature', 0, 'ud:form'))),
         ('precedence 2',
          '''unit N word
          N.ud:form = N.ud:lemma + "ing"''',
-         ('AND',
-          ('=', ('feature', 0, 'meta:active'), True),
-          ('=',
-           ('feature', 0, 'ud:form'),
-           ('+', ('feature', 0, 'ud:lemma'), "ing")))),
+         ('=',
+          ('feature', 0, 'ud:form'),
+          ('+', ('feature', 0, 'ud:lemma'), "ing"))),
         ('reference',
          '''unit N word
          unit H word
          N.head = H''',
-         ('AND',
-          ('AND',
-           ('=', ('feature', 0, 'meta:active'), True),
-           ('=', ('feature', 1, 'meta:active'), True)),
-          ('=',
-           ('feature', 0, 'head'),
-           ('unit', 1)))),
+         ('=',
+          ('feature', 0, 'head'),
+          ('unit', 1))),
     ]
 
     def commands(self, db_name):
@@ -366,3 +354,1015 @@ class QueryParseTrees(SimpleTest, unittest.TestCase):
             with self.subTest(n=name):
                 q = Query.parse_query(db, text)
                 self.validate_node(q.conditional, tree)
+
+class MigrationTest(SimpleTest, unittest.TestCase):
+    def commands(self, db_name):
+        # create a file at the original schema version
+        import sqlite3
+        from rebabel_format.db import load_schema
+        con = sqlite3.connect(db_name)
+        con.executescript(load_schema())
+        con.close()
+
+    def checks(self, db):
+        from rebabel_format.db import MIGRATIONS
+        self.assertEqual(MIGRATIONS[-1][0], db.schema_version())
+        db.cur.execute("SELECT name FROM sqlite_master WHERE type = 'index'")
+        indexes = set(x[0] for x in db.cur.fetchall())
+        for name in ['features_feature_value', 'relations_child',
+                     'relations_parent', 'units_type', 'ancestry_descendant']:
+            self.assertIn(name, indexes)
+
+        # a failed step is rolled back and leaves the version alone
+        import sqlite3
+        latest = MIGRATIONS[-1][0]
+        newer = (latest[0], latest[1] + 1)
+        MIGRATIONS.append((newer, 'CREATE TABLE ancestry_extra(x);\nCREATE TABLE units(x);'))
+        try:
+            with self.assertRaises(sqlite3.Error):
+                db.migrate()
+        finally:
+            MIGRATIONS.pop()
+        self.assertFalse(db.con.in_transaction)
+        self.assertEqual(latest, db.schema_version())
+        db.cur.execute("SELECT name FROM sqlite_master WHERE name = 'ancestry_extra'")
+        self.assertEqual([], db.cur.fetchall())
+
+        # files from newer versions are refused, even for a minor version
+        db.cur.execute('UPDATE metadata SET schema_minor = ?', (newer[1],))
+        db.con.commit()
+        from rebabel_format.db import RBBLFile
+        with self.assertRaises(ValueError):
+            RBBLFile(db.path)
+
+class ProfileTest(SimpleTest, unittest.TestCase):
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+
+    def checks(self, db):
+        def pragma(name):
+            db.cur.execute(f'PRAGMA {name}')
+            return db.cur.fetchone()[0]
+
+        # the import should have switched back from bulk-import
+        self.assertEqual('delete', pragma('journal_mode'))
+        with db.use_profile('read-mostly'):
+            self.assertEqual('wal', pragma('journal_mode'))
+            self.assertEqual(1, pragma('synchronous'))
+        with db.use_profile('bulk-import'):
+            # OFF can corrupt the file if the OS crashes
+            self.assertEqual(1, pragma('synchronous'))
+        self.assertEqual('delete', pragma('journal_mode'))
+        self.assertEqual(2, pragma('synchronous'))
+        with self.assertRaisesRegex(ValueError, 'Unknown database profile'):
+            db.set_profile('fast')
+
+class CatalogTest(SimpleTest, unittest.TestCase):
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+
+    def checks(self, db):
+        fid, ftype = db.get_feature('word', 'UD:lemma')
+        self.assertEqual('str', ftype)
+        hits = db.catalog.hits
+        misses = db.catalog.misses
+        for i in range(3):
+            self.assertEqual((fid, ftype), db.get_feature('word', 'UD:lemma'))
+        self.assertEqual(hits + 3, db.catalog.hits)
+        self.assertEqual(misses, db.catalog.misses)
+
+        self.assertEqual((None, None), db.get_feature('word', 'UD:nothing'))
+        self.assertEqual(misses + 1, db.catalog.misses)
+        # failed lookups are remembered too
+        for i in range(3):
+            self.assertEqual([], db.get_feature_multi_type(['word'], 'UD:nothing'))
+            self.assertIsNone(db.catalog.get_by_id(-1))
+        self.assertEqual(misses + 2, db.catalog.misses)
+        db.create_feature('word', 'UD:nothing', 'int')
+        self.assertEqual('int', db.get_feature('word', 'UD:nothing')[1])
+        self.assertEqual(misses + 2, db.catalog.misses)
+
+class UnitTypeCacheTest(SimpleTest, unittest.TestCase):
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+
+    def checks(self, db):
+        db.unit_types.clear()
+        db.unit_type_cache_size = 3
+        words = db.get_units('word')
+        db.prefetch_unit_types(words)
+        self.assertEqual(words[:3], list(db.unit_types.keys()))
+        self.assertEqual('word', db.get_unit_type(words[0]))
+        self.assertEqual('word', db.get_unit_type(words[5]))
+        # words[1] was least recently used, so it should have been evicted
+        self.assertEqual([words[2], words[0], words[5]],
+                         list(db.unit_types.keys()))
+        with self.assertRaises(ValueError):
+            db.get_unit_type(-1)
+
+class BulkWriteTest(SimpleTest, unittest.TestCase):
+    def commands(self, db_name):
+        from rebabel_format.db import RBBLFile
+        db = RBBLFile(db_name)
+        db.create_feature('word', 'form', 'str')
+
+    def checks(self, db):
+        sent = db.create_unit('sentence', user='test')
+        words = db.create_units_many(['word']*3, user='test')
+        self.assertEqual([sent+1, sent+2, sent+3], words)
+        self.assertEqual(['word']*3, [db.get_unit_type(w) for w in words])
+        active = db.get_feature_value_by_name(words[0], 'meta:active')
+        self.assertEqual(True, db.interpret_value(active, 'bool'))
+
+        db.set_features_many([(w, 'form', f'w{i}', 'test', 1)
+                              for i, w in enumerate(words)])
+        db.set_features_many([(words[0], 'form', 'changed', 'test', 1)])
+        self.assertEqual(['changed', 'w1', 'w2'],
+                         [db.get_feature_value_by_name(w, 'form') for w in words])
+        db.cur.execute('SELECT value FROM history')
+        self.assertEqual([('w0',)], db.cur.fetchall())
+        with self.assertRaises(ValueError):
+            db.set_features_many([(words[1], 'form', 'ok', 'test', 1),
+                                  (words[2], 'form', 3, 'test', 1)])
+        self.assertEqual('w1', db.get_feature_value_by_name(words[1], 'form'))
+
+        db.set_parents_many([(sent, w) for w in words])
+        self.assertEqual([sent]*3, [db.get_parent(w) for w in words])
+
+        # another connection can't take the IDs once they are chosen
+        import sqlite3
+        other = sqlite3.connect(db.path, timeout=0)
+        now = db.now
+        blocked = []
+        def now_and_write():
+            try:
+                other.execute("INSERT INTO units(type, created, modified, active) VALUES('word', 'now', 'now', X'31')")
+                other.commit()
+            except sqlite3.OperationalError:
+                other.rollback()
+                blocked.append(True)
+            return now()
+        db.now = now_and_write
+        try:
+            more = db.create_units_many(['word']*3, user='test')
+        finally:
+            db.now = now
+            other.close()
+        self.assertTrue(blocked)
+        self.assertEqual(['word']*3, [db.get_unit_type(w) for w in more])
+        self.assertEqual(list(range(more[0], more[0] + 3)), more)
+
+class SetBasedTransformTest(SimpleTest, unittest.TestCase):
+    commands_config = {
+        'sequence': ['create', 'copy', 'set', 'remove', 'deactivate'],
+        'create': {
+            'query': {'W': {'type': 'word'}},
+            'commands': [{'type': 'create_feature', 'unit_type': 'word',
+                          'feature': 'UD:MISC:Gloss', 'value_type': 'str'}],
+        },
+        'copy': {
+            'query': {'W': {'type': 'word'}},
+            'commands': [{'type': 'copy_feature', 'target': 'W',
+                          'target_feature': 'UD:MISC:Gloss', 'source': 'W',
+                          'source_feature': 'UD:lemma', 'prepend': '<',
+                          'append': '>'}],
+        },
+        'set': {
+            'query': {'W': {'type': 'word',
+                            'features': [{'feature': 'UD:upos',
+                                          'value': 'NOUN'}]}},
+            'commands': [{'type': 'set_feature', 'target': 'W',
+                          'feature': 'UD:lemma', 'value': 'thing'}],
+        },
+        'remove': {
+            'query': {'W': {'type': 'word',
+                            'features': [{'feature': 'UD:upos',
+                                          'value': 'DET'}]}},
+            'commands': [{'type': 'remove_feature', 'target': 'W',
+                          'feature': 'UD:MISC:Gloss'}],
+        },
+        'deactivate': {
+            'query': {'W': {'type': 'word',
+                            'features': [{'feature': 'UD:upos',
+                                          'value': 'PUNCT'}]}},
+            'commands': [{'type': 'remove_feature', 'target': 'W',
+                          'feature': 'meta:active'}],
+        },
+    }
+
+    def commands(self, db_name):
+        for name, set_based in [(db_name+'.rows', False), (db_name, True)]:
+            if os.path.isfile(name):
+                os.remove(name)
+            run_command('import', {}, infiles=['data/basic.conllu'],
+                        mode='conllu', db=name)
+            run_command('transform', {'transform': self.commands_config},
+                        db=name, user='test', set_based=set_based)
+
+    def checks(self, db):
+        from rebabel_format.db import RBBLFile
+        rows = RBBLFile(db.path + '.rows')
+        for table in ['features', 'history']:
+            with self.subTest(table):
+                qr = f'SELECT unit, feature, value, user, confidence FROM {table} ORDER BY unit, feature, value'
+                rows.cur.execute(qr)
+                db.cur.execute(qr)
+                self.assertEqual(rows.cur.fetchall(), db.cur.fetchall())
+        qr = 'SELECT id, active FROM units ORDER BY id'
+        rows.cur.execute(qr)
+        db.cur.execute(qr)
+        self.assertEqual(rows.cur.fetchall(), db.cur.fetchall())
+        words = db.get_units('word')
+        self.assertEqual(
+            db.first("SELECT COUNT(*) FROM units WHERE type = 'word'")[0],
+            len(words) + 2)
+        glosses = db.get_feature_values(words, db.get_feature('word', 'UD:MISC:Gloss')[0])
+        self.assertIn('<man>', glosses.values())
+
+class StreamTest(SimpleTest, unittest.TestCase):
+    query = {
+        'S': {'type': 'sentence'},
+        'W': {'type': 'word', 'parent': 'S'},
+    }
+
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+
+    def checks(self, db):
+        from rebabel_format.query import Query
+        expected = list(Query.parse_query(db, self.query).search())
+        self.assertEqual(8, len(expected))
+        for snapshot in [False, True]:
+            with self.subTest(snapshot=snapshot):
+                q = Query.parse_query(db, self.query)
+                self.assertEqual(expected,
+                                 list(q.stream(batch_size=3, snapshot=snapshot)))
+
+class OrderTest(SimpleTest, unittest.TestCase):
+    query = {
+        'S': {'type': 'sentence', 'order': 'meta:index'},
+        'W': {'type': 'word', 'parent': 'S', 'order': 'UD:FEATS:Number'},
+    }
+
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+
+    def checks(self, db):
+        from rebabel_format.query import Query
+        results = list(Query.parse_query(db, self.query).search())
+        self.assertEqual(8, len(results))
+        number, _ = db.get_feature('word', 'UD:FEATS:Number')
+        index, _ = db.get_feature('sentence', 'meta:index')
+        def key(res):
+            db.cur.execute('SELECT value FROM features WHERE unit = ? AND feature = ?',
+                           (res['W'], number))
+            w = db.cur.fetchone()
+            db.cur.execute('SELECT value FROM features WHERE unit = ? AND feature = ?',
+                           (res['S'], index))
+            return (db.cur.fetchone()[0], w is None, w[0] if w else res['W'])
+        self.assertEqual(sorted(results, key=key), results)
+        # units without the order feature sort last
+        self.assertIsNotNone(key(results[0])[2])
+        self.assertTrue(key(results[-1])[1])
+        q = Query.parse_query(db, self.query)
+        self.assertTrue(q.can_stream())
+        self.assertEqual(results, list(q.stream(batch_size=3)))
+
+class SubqueryTest(SimpleTest, unittest.TestCase):
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+
+    def search(self, db, mn, mx, upos=None, nested=False):
+        from rebabel_format.query import Query
+        Q = Query(db)
+        S = Q.unit('sentence', 'S')
+        sub, S2 = S.subquery(min=mn, max=mx)
+        W = sub.unit('word', 'W')
+        sub.add(W.parent(S2))
+        if upos:
+            sub.add(W['UD:upos'] == upos)
+        if nested:
+            nq, W2 = W.subquery(min=1, max=1)
+            P = nq.unit('sentence', 'P')
+            nq.add(W2.parent(P))
+        return list(Q.search())
+
+    def checks(self, db):
+        cases = [
+            (1, None, None, 2), (4, 4, None, 2), (5, None, None, 0),
+            (0, 3, None, 0), (0, 0, 'NOUN', 0), (0, 0, 'ADJ', 2),
+            (1, 1, 'VERB', 2), (2, None, 'VERB', 0),
+        ]
+        for mn, mx, upos, count in cases:
+            for nested in [False, True]:
+                with self.subTest(min=mn, max=mx, upos=upos, nested=nested):
+                    results = self.search(db, mn, mx, upos, nested)
+                    self.assertEqual(count, len(results))
+                    for res in results:
+                        words = res[('S', 0)]
+                        self.assertTrue(mn <= len(words))
+                        if mx is not None:
+                            self.assertTrue(len(words) <= mx)
+                        for w in words:
+                            self.assertEqual(res['S'], w['S'])
+                            if nested:
+                                self.assertEqual(res['S'], w[('W', 0)][0]['P'])
+
+class ExplainTest(SimpleTest, unittest.TestCase):
+    query = {
+        'S': {
+            'type': 'sentence',
+            'subqueries': [{
+                'min': 1,
+                'W': {'type': 'word', 'parent': 'S',
+                      'features': [{'feature': 'UD:upos', 'value': 'NOUN'}]},
+            }],
+        },
+    }
+
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+        self.outputs = {}
+        for execute in [False, True]:
+            stream = io.StringIO()
+            with contextlib.redirect_stdout(stream):
+                run_command('explain', {}, db=db_name, query=self.query,
+                            execute=execute)
+            self.outputs[execute] = stream.getvalue()
+
+    def checks(self, db):
+        plain = self.outputs[False]
+        self.assertIn('SQL: SELECT DISTINCT', plain)
+        self.assertIn('Query plan:', plain)
+        self.assertNotIn('Subquery S.1', plain)
+        executed = self.outputs[True]
+        self.assertIn('Subquery S.1:', executed)
+        self.assertIn('  Subquery S.1: 2\n', executed)
+        self.assertIn('  Results: 2\n', executed)
+
+class AnalyzeTest(SimpleTest, unittest.TestCase):
+    query = {
+        'S': {'type': 'sentence'},
+        'W': {'type': 'word', 'parent': 'S',
+              'features': [{'feature': 'UD:upos', 'value': 'VERB'},
+                           {'feature': 'UD:lemma', 'value': 'snore'}]},
+    }
+
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+
+    def checks(self, db):
+        from rebabel_format.query import Query
+        Q = Query.parse_query(db, self.query)
+        sql, _ = Q.compile()
+        self.assertNotIn('CROSS JOIN', sql)
+        expected = list(Q.search())
+        self.assertEqual(1, len(expected))
+
+        run_command('analyze', {}, db=db.path, common_values=2)
+        db.stats.reload()
+        self.assertEqual(8, db.stats.count_units('word'))
+        upos, _ = db.get_feature('word', 'UD:upos')
+        lemma, _ = db.get_feature('word', 'UD:lemma')
+        self.assertEqual(8, db.stats.count_tiers([upos]))
+        self.assertEqual(2, db.stats.count_value([upos], 'VERB'))
+        # 4 lemmas not among the 2 most common share the remaining 4 rows
+        self.assertEqual(1, db.stats.count_value([lemma], 'snore'))
+
+        Q = Query.parse_query(db, self.query)
+        sql, _ = Q.compile()
+        n = Q.get_feature(1, 'UD:lemma', False)[0]
+        self.assertIn(f'FROM features F{n} CROSS JOIN units TU1 CROSS JOIN', sql)
+        self.assertEqual(expected, list(Q.search()))
+
+        # other comparisons also make a feature more selective than
+        # the unit it belongs to
+        query = {'W': {'type': 'word', 'features': [
+            {'feature': 'UD:lemma', 'value_contains': 'oma'}]}}
+        Q = Query.parse_query(db, query)
+        sql, _ = Q.compile()
+        n = Q.get_feature(0, 'UD:lemma', False)[0]
+        self.assertIn(f'FROM features F{n} CROSS JOIN units TU0', sql)
+        self.assertEqual(1, len(list(Q.search())))
+
+        # cached queries are planned with the actual values, not the
+        # template's placeholders
+        query = {
+            'W': {'type': 'word',
+                  'features': [{'feature': 'UD:FEATS:Number', 'value': 'Sing'},
+                               {'feature': 'UD:lemma', 'value': 'snore'}]},
+        }
+        def plan(Q):
+            sql, params = Q.compile()
+            db.cur.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            return sql, [row[-1] for row in db.cur.fetchall()]
+        fresh = Query(db)
+        fresh.parse(query)
+        sql, steps = plan(fresh)
+        n = fresh.get_feature(0, 'UD:lemma', False)[0]
+        self.assertTrue(sql.split(' FROM ')[1].startswith(f'features F{n} '))
+        db.query_cache.clear()
+        for i in range(2):
+            self.assertEqual((sql, steps), plan(Query.parse_query(db, query)))
+
+class ActiveTest(SimpleTest, unittest.TestCase):
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+
+    def checks(self, db):
+        from rebabel_format.query import Query
+        def words():
+            return [r['W'] for r in Query.parse_query(db, 'unit W word').search()]
+        def active(uid):
+            db.cur.execute('SELECT active FROM units WHERE id = ?', (uid,))
+            return db.interpret_value(db.cur.fetchone()[0], 'bool')
+        all_words = words()
+        self.assertEqual(8, len(all_words))
+        db.rem_unit(all_words[0], 'test')
+        self.assertFalse(active(all_words[0]))
+        self.assertEqual(all_words[1:], words())
+        db.set_feature(all_words[0], 'meta:active', True, 'test')
+        self.assertTrue(active(all_words[0]))
+        db.set_features_many([(u, 'meta:active', False, 'test', 1)
+                              for u in all_words[:4]])
+        self.assertEqual(all_words[4:], words())
+        db.set_features_many([(u, 'meta:active', True, 'test', 1)
+                              for u in all_words[:4]])
+        self.assertEqual(all_words, words())
+
+class LargeListTest(SimpleTest, unittest.TestCase):
+    query = {
+        'S': {
+            'type': 'sentence',
+            'subqueries': [{
+                'W': {'type': 'word', 'parent': 'S'},
+            }],
+        },
+    }
+
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+
+    def run_all(self, db):
+        from rebabel_format.query import Query
+        results = list(Query.parse_query(db, self.query).search())
+        words = sorted(r['W'] for r in Query.parse_query(db, 'unit W word').search())
+        values = db.get_feature_values(words, db.get_feature('word', 'UD:lemma')[0])
+        out = db.path + '.conllu'
+        run_command('export', {}, mode='conllu', db=db.path, outfile=out)
+        with open(out) as fin:
+            return results, values, fin.read()
+
+    def checks(self, db):
+        from rebabel_format.db import WhereClause
+        sql, params = WhereClause('unit', [1, 2, 3]).toSQL()
+        self.assertIn('?, ?, ?', sql)
+        expected = self.run_all(db)
+        self.assertEqual(8, len(expected[1]))
+        try:
+            WhereClause.list_threshold = 1
+            sql, params = WhereClause('unit', [1, 2, 3], negated=True).toSQL()
+            self.assertEqual('unit NOT IN (SELECT value FROM json_each(?))', sql)
+            self.assertEqual(['[1, 2, 3]'], params)
+            # booleans aren't stored the way JSON represents them
+            sql, params = WhereClause('active', [True, False]).toSQL()
+            self.assertEqual([True, False], params)
+            self.assertEqual(expected, self.run_all(db))
+        finally:
+            WhereClause.list_threshold = 500
+
+class QueryCacheTest(SimpleTest, unittest.TestCase):
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+
+    def query(self, lemma):
+        return {
+            'S': {'type': 'sentence'},
+            'W': {'type': 'word', 'parent': 'S',
+                  'features': [{'feature': 'UD:lemma', 'value': lemma}]},
+        }
+
+    def checks(self, db):
+        from rebabel_format.query import Query
+        def count(query):
+            return len(list(Query.parse_query(db, query).search()))
+
+        db.query_cache.clear()
+        self.assertEqual(2, count(self.query('the')))
+        self.assertEqual(1, count(self.query('snore')))
+        self.assertEqual(0, count(self.query('bark')))
+        self.assertEqual(1, len(db.query_cache))
+        # the type of the value is part of the key
+        self.assertEqual(0, count(self.query(5)))
+        self.assertEqual(2, len(db.query_cache))
+
+        text = 'unit W word\nW.UD:upos = "NOUN"'
+        self.assertEqual(2, count(text))
+        self.assertEqual(2, count(text))
+        self.assertEqual(3, len(db.query_cache))
+
+        # modifying a cached query doesn't change the cache
+        Q = Query.parse_query(db, text)
+        Q.add(Q['W']['UD:lemma'] == 'man')
+        self.assertEqual(1, len(list(Q.search())))
+        self.assertEqual(2, count(text))
+
+        # adding a tier invalidates everything
+        key = next(iter(db.query_cache))
+        template = db.query_cache[key][1]
+        db.create_feature('word', 'UD:misc', 'str')
+        self.assertEqual(2, count(self.query('the')))
+        self.assertIsNot(template, db.query_cache[key][1])
+
+        # failed templates are dropped
+        bad = {'W': {'type': 'word', 'features': [{'feature': 'UD:nope', 'value': 'x'}]}}
+        for i in range(2):
+            with self.assertRaisesRegex(ValueError, "No feature 'UD:nope'"):
+                count(bad)
+        self.assertFalse(any('UD:nope' in k for k in db.query_cache))
+
+        # units belong to the instance, not the template
+        Q = Query.parse_query(db, text)
+        template = Q.template
+        self.assertIsNot(template['W'], Q['W'])
+        Q['W'].subquery()
+        self.assertEqual(1, len(Q.subqueries))
+        self.assertEqual([], template.subqueries)
+        self.assertEqual(2, count(text))
+
+        # limits apply to the instance without reparsing it
+        Q = Query.parse_query(db, self.query('the'))
+        Q.set_limit(1)
+        self.assertIsNotNone(Q.template)
+        self.assertEqual(1, len(list(Q.search())))
+        self.assertEqual(2, count(self.query('the')))
+
+        # patterns are checked when they are filled in
+        pattern = {'W': {'type': 'word', 'features': [
+            {'feature': 'UD:lemma', 'value_matches': '^s'}]}}
+        self.assertEqual(2, count(pattern))
+        with self.assertRaisesRegex(ValueError, 'Invalid regular expression'):
+            Query.parse_query(db, {'W': {'type': 'word', 'features': [
+                {'feature': 'UD:lemma', 'value_matches': '('}]}})
+
+class ResultCacheTest(SimpleTest, unittest.TestCase):
+    query = {
+        'W': {'type': 'word',
+              'features': [{'feature': 'UD:upos', 'value': 'NOUN'}]},
+    }
+
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+        with contextlib.redirect_stdout(io.StringIO()):
+            run_command('query', {}, db=db_name, query=self.query,
+                        cache_results=True)
+
+    def checks(self, db):
+        import sqlite3
+        from rebabel_format.query import Query
+        def tamper():
+            # from another connection, to check that the stored result is used
+            con = sqlite3.connect(db.path)
+            con.execute("UPDATE result_cache SET result = '[[1]]'")
+            con.commit()
+            con.close()
+        def nouns():
+            return [r['W'] for r in Query.parse_query(db, self.query).search()]
+        db.cur.execute('SELECT COUNT(*) FROM result_cache')
+        self.assertEqual(1, db.cur.fetchone()[0])
+
+        db.result_cache = True
+        expected = nouns()
+        self.assertEqual(2, len(expected))
+        tamper()
+        self.assertEqual([1], nouns())
+
+        # writes through RBBLFile invalidate the cache
+        generation = db.change_generation()
+        db.create_unit('word')
+        self.assertGreater(db.change_generation(), generation)
+        self.assertEqual(expected, nouns())
+
+        # so do edits from other connections, via the triggers
+        tamper()
+        self.assertEqual([1], nouns())
+        con = sqlite3.connect(db.path)
+        con.execute("UPDATE features SET value = 'VERB' WHERE unit = ? AND feature = ?",
+                    (expected[0], db.get_feature('word', 'UD:upos')[0]))
+        con.commit()
+        con.close()
+        self.assertEqual(expected[1:], nouns())
+
+class IncrementalTest(SimpleTest, unittest.TestCase):
+    query = {
+        'S': {'type': 'sentence'},
+        'W': {'type': 'word', 'parent': 'S',
+              'features': [{'feature': 'UD:upos', 'value': 'NOUN'}]},
+    }
+
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+
+    def checks(self, db):
+        from rebabel_format.query import Query, search, search_changes
+        since = '2099-12-31T00:00:00'
+        db.current_time = '2100-01-01T00:00:00'
+        previous = list(Query.parse_query(db, self.query).search())
+        self.assertEqual(2, len(previous))
+        self.assertEqual(([], []), search_changes(db, self.query, since, previous))
+
+        words = [r['W'] for r in Query.parse_query(db, 'unit W word').search()]
+        db.set_feature(previous[0]['W'], 'UD:upos', 'VERB', 'test')
+        db.set_feature(words[4], 'UD:upos', 'NOUN', 'test')
+        added, retracted = search_changes(db, self.query, since, previous)
+        self.assertEqual([{'S': previous[1]['S'], 'W': words[4]}], added)
+        self.assertEqual(previous[:1], retracted)
+        self.assertEqual(added, list(search(db, self.query, since=since)))
+        self.assertEqual(2, len(list(search(db, self.query))))
+
+        # relation changes count as modifications of both units
+        later = '2100-06-01T00:00:00'
+        db.current_time = '2100-12-01T00:00:00'
+        db.set_parent(previous[0]['S'], words[4])
+        self.assertEqual([previous[0]['S'], previous[1]['S']],
+                         [r['S'] for r in search(db, self.query, since=later)])
+
+        # matches with subqueries include lists of results
+        nested = {'S': {'type': 'sentence', 'subqueries': [{
+            'W': {'type': 'word', 'parent': 'S'}}]}}
+        previous = list(search(db, nested))
+        self.assertEqual(2, len(previous))
+        latest = '2101-06-01T00:00:00'
+        db.current_time = '2101-12-01T00:00:00'
+        db.set_feature(previous[1]['S'], 'UD:sent_id', '3', 'test')
+        added, retracted = search_changes(db, nested, latest, previous)
+        self.assertEqual(previous[1:], retracted)
+        self.assertEqual([previous[1]['S']], [r['S'] for r in added])
+
+class AncestryTest(SimpleTest, unittest.TestCase):
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/merge_text.flextext'],
+                    mode='flextext', db=db_name)
+
+    def checks(self, db):
+        from rebabel_format.db import MIGRATIONS
+        from rebabel_format.query import Query
+        def words_in(container):
+            return [r['W'] for r in Query.parse_query(db, f'unit C {container}\nunit W word\nW ancestor C').search()]
+        def closure():
+            db.cur.execute('SELECT ancestor, descendant FROM ancestry ORDER BY ancestor, descendant')
+            return db.cur.fetchall()
+
+        words = words_in('interlinear-text')
+        self.assertEqual(8, len(words))
+        self.assertEqual(words, words_in('paragraph'))
+        self.assertEqual(words, words_in('phrase'))
+        self.assertEqual([], words_in('word'))
+        dict_query = {
+            'P': {'type': 'paragraph'},
+            'W': {'type': 'word', 'ancestor': 'P'},
+        }
+        self.assertEqual(words, [r['W'] for r in Query.parse_query(db, dict_query).search()])
+        # inside OR, the condition is checked with EXISTS instead
+        either = 'unit T interlinear-text\nunit W word\nT descendant W or W.FlexText:en:txt = "none"'
+        self.assertEqual(words, [r['W'] for r in Query.parse_query(db, either).search()])
+
+        # the table built by the migration matches the maintained one
+        expected = closure()
+        db.cur.execute('DELETE FROM ancestry')
+        db.con.executescript(MIGRATIONS[4][1])
+        self.assertEqual(expected, closure())
+
+        phrases = [r['P'] for r in Query.parse_query(db, 'unit P phrase').search()]
+        first = [r['W'] for r in Query.parse_query(db, 'unit P phrase\nunit W word\nW parent P').search()
+                 if r['P'] == phrases[0]]
+        db.rem_unit(phrases[0], 'test')
+        self.assertEqual(words[len(first):], words_in('paragraph'))
+        para = [r['P'] for r in Query.parse_query(db, 'unit P paragraph').search()][0]
+        db.set_parent(para, first[0])
+        self.assertEqual([first[0]] + words[len(first):], words_in('paragraph'))
+        db.rem_parent(para, first[0])
+        self.assertEqual(words[len(first):], words_in('paragraph'))
+
+class PaginationTest(SimpleTest, unittest.TestCase):
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+
+    def checks(self, db):
+        from rebabel_format.query import Query, search
+        def ids(query, **kwargs):
+            return [r['W'] for r in search(db, query, **kwargs)]
+        words = ids('unit W word')
+        self.assertEqual(8, len(words))
+        self.assertEqual(words[:3], ids('unit W word', limit=3))
+        self.assertEqual(words[2:5], ids('unit W word', limit=3, offset=2))
+        self.assertEqual(words[5:], ids('unit W word', offset=5, stream=True))
+        self.assertEqual(words[6:], ids('unit W word\nlimit 2\noffset 6'))
+        self.assertEqual(words[:2], ids({'W': {'type': 'word'}, 'limit': 2}))
+        with self.assertRaises(ValueError):
+            Query.parse_query(db, 'unit W word\nlimit many')
+        with self.assertRaises(ValueError):
+            Query.parse_query(db, 'unit W word\nlimit 2\nsample 2')
+
+        sample = ids('unit W word', sample=3)
+        self.assertEqual(3, len(set(sample)))
+        self.assertEqual(sorted(sample), sample)
+        self.assertTrue(set(sample) <= set(words))
+        self.assertEqual(words, ids('unit W word', sample=100))
+        # samples are sorted like everything else
+        ordered = {'W': {'type': 'word', 'order': 'UD:form'}}
+        self.assertEqual(ids(ordered), ids(ordered, sample=8))
+
+        # the nested subquery means that the outer one is checked in
+        # Python, so the limit must be too
+        query = {
+            'S': {
+                'type': 'sentence',
+                'subqueries': [{
+                    'W': {'type': 'word', 'parent': 'S',
+                          'subqueries': [{'X': {'type': 'word', 'parent': 'W'},
+                                          'min': 0}]},
+                }],
+            },
+        }
+        sentences = [r['S'] for r in search(db, query)]
+        self.assertEqual(2, len(sentences))
+        self.assertEqual(sentences[1:], [r['S'] for r in search(db, query, limit=1, offset=1)])
+        self.assertEqual(1, len(list(search(db, query, sample=1))))
+
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            run_command('query', {}, db=db.path, query={'W': {'type': 'word'}},
+                        limit=2)
+        self.assertEqual(2, out.getvalue().count('Result'))
+
+class AggregateTest(SimpleTest, unittest.TestCase):
+    query = {
+        'S': {'type': 'sentence'},
+        'W': {'type': 'word', 'parent': 'S'},
+    }
+
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+
+    def checks(self, db):
+        from rebabel_format.query import Query
+        def Q(query=None, **kwargs):
+            return Query.parse_query(db, dict(query or self.query, **kwargs))
+        self.assertEqual(8, Q().count())
+        self.assertEqual(2, Q().count(distinct='S'))
+        self.assertEqual(3, Q(limit=3).count())
+        self.assertEqual(
+            [(('DET',), 2), (('NOUN',), 2), (('PUNCT',), 2), (('VERB',), 2)],
+            Q().aggregate([('W', 'UD:upos')]))
+        self.assertEqual(
+            [((None,), 4), (('Sing',), 4)],
+            Q().aggregate([('W', 'UD:FEATS:Number')]))
+        self.assertEqual(
+            [((None,), 2), (('Sing',), 2)],
+            Q().aggregate([('W', 'UD:FEATS:Number')], distinct='S'))
+        with self.assertRaises(ValueError):
+            Q().aggregate([('X', 'UD:upos')])
+
+        # a nested subquery which can't be checked in SQL
+        nested = {
+            'S': {
+                'type': 'sentence',
+                'subqueries': [{
+                    'W': {'type': 'word', 'parent': 'S',
+                          'subqueries': [{'X': {'type': 'word', 'parent': 'W'},
+                                          'min': 0}]},
+                }],
+            },
+        }
+        self.assertEqual([(('1',), 1), (('2',), 1)],
+                         Q(nested).aggregate([('S', 'UD:sent_id')]))
+
+class TextIndexTest(SimpleTest, unittest.TestCase):
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+
+    def checks(self, db):
+        from rebabel_format.query import Query
+        queries = [
+            'unit W word\nW.UD:form contains "oma"',
+            'unit W word\nW.UD:form startswith "sno"',
+            'unit W word\nW.UD:form endswith "ngs"',
+            'unit W word\nW.UD:form endswith "ma"',
+            'unit W word\nW.UD:form contains "n"',
+            {'W': {'type': 'word',
+                   'features': [{'feature': 'UD:form', 'value_contains': 'man'}]}},
+        ]
+        def run_all():
+            return [[r['W'] for r in Query.parse_query(db, q).search()]
+                    for q in queries]
+        expected = run_all()
+        self.assertEqual([1, 1, 1, 0, 4, 2], [len(x) for x in expected])
+
+        self.assertFalse(db.text_index)
+        db.create_text_index()
+        self.assertTrue(db.text_index)
+        self.assertEqual(expected, run_all())
+        sql, _ = Query.parse_query(db, queries[0]).compile()
+        self.assertIn('features_fts', sql)
+        sql, _ = Query.parse_query(db, queries[4]).compile()
+        self.assertNotIn('features_fts', sql)
+
+        # with statistics, the indexed feature is still searched first
+        # rather than checking every unit
+        run_command('analyze', {}, db=db.path)
+        db.stats.reload()
+        both = {'W': {'type': 'word', 'features': [
+            {'feature': 'UD:form', 'value_contains': 'oma'},
+            {'feature': 'UD:upos', 'value': 'NOUN'}]}}
+        for query in [queries[0], queries[5], both]:
+            Q = Query.parse_query(db, query)
+            sql, params = Q.compile()
+            n = Q.get_feature(0, 'UD:form', False)[0]
+            self.assertIn(f' FROM features F{n} CROSS JOIN units TU0', sql)
+            db.cur.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            plan = [row[-1] for row in db.cur.fetchall()]
+            self.assertNotIn('SCAN TU0', plan)
+            self.assertIn('features_fts', ' '.join(plan))
+        self.assertEqual(expected, run_all())
+        self.assertEqual(expected[0], [r['W'] for r in Query.parse_query(db, both).search()])
+
+        # the triggers keep it up to date
+        woman = expected[0][0]
+        db.set_feature(woman, 'UD:form', 'lady', 'test')
+        self.assertEqual([], [r['W'] for r in Query.parse_query(db, queries[0]).search()])
+        db.set_feature(woman, 'UD:form', 'woman', 'test')
+        self.assertEqual(expected, run_all())
+        db.cur.execute("SELECT COUNT(*) FROM features_fts WHERE value LIKE '%lady%'")
+        self.assertEqual(0, db.cur.fetchone()[0])
+
+        db.drop_text_index()
+        self.assertFalse(db.text_index)
+        self.assertEqual(expected, run_all())
+
+class PatternTest(SimpleTest, unittest.TestCase):
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/basic.conllu'],
+                    mode='conllu', db=db_name)
+
+    def checks(self, db):
+        from rebabel_format.query import Query
+        def count(query):
+            return len(list(Query.parse_query(db, query).search()))
+        def spec(**kwargs):
+            return {'W': {'type': 'word',
+                          'features': [dict(feature='UD:form', **kwargs)]}}
+        self.assertEqual(2, count('unit W word\nW.UD:form matches "^[A-Z]"'))
+        self.assertEqual(0, count('unit W word\nW.UD:form matches "^the$"'))
+        self.assertEqual(2, count('unit W word\nW.UD:form imatches "^the$"'))
+        self.assertEqual(2, count('unit W word\nW.UD:form iequals "THE"'))
+        self.assertEqual(4, count('unit W word\nW.UD:form imatches "s$" or W.UD:form = "."'))
+        self.assertEqual(4, count(spec(value_matches='^(wo)?man$|^The$')))
+        self.assertEqual(6, count(spec(value_notiequals='the')))
+        self.assertEqual(2, count(spec(value_imatches=['^MAN', '^woman'])))
+        with self.assertRaises(ValueError):
+            count('unit W word\nW.UD:form matches "("')
+
+        Q = Query(db)
+        W = Q.unit('word', 'W')
+        Q.add(W['UD:form'].matches('s$'))
+        self.assertEqual(2, len(list(Q.search())))
+
+        if db.deterministic:
+            db.create_casefold_index()
+            db.cur.execute("SELECT name FROM sqlite_master WHERE name = 'features_casefold'")
+            self.assertEqual(1, len(db.cur.fetchall()))
+            self.assertEqual(1, count(spec(value_iequals='MAN')))
+            db.drop_casefold_index()
+
+class ParallelImportTest(SimpleTest, unittest.TestCase):
+    infiles = ['data/basic.conllu', 'data/tiny.conllu', 'data/basic.conllu']
+
+    def commands(self, db_name):
+        run_command('import', {}, infiles=self.infiles, mode='conllu',
+                    db=db_name, workers=2)
+        seq_name = 'Sequential' + db_name
+        if os.path.isfile(seq_name):
+            os.remove(seq_name)
+        run_command('import', {}, infiles=self.infiles, mode='conllu',
+                    db=seq_name)
+
+    def dump(self, db):
+        db.cur.execute('SELECT id, type, active FROM units ORDER BY id')
+        units = db.cur.fetchall()
+        db.cur.execute('SELECT parent, child, isprimary, active FROM relations ORDER BY child, parent')
+        relations = db.cur.fetchall()
+        db.cur.execute('SELECT T.name, T.unittype, F.unit, F.value FROM features F, tiers T WHERE F.feature = T.id ORDER BY F.unit, T.name')
+        features = db.cur.fetchall()
+        return units, relations, features
+
+    def indices(self, db):
+        db.cur.execute("SELECT F.value FROM features F, tiers T WHERE F.feature = T.id AND T.name = 'meta:index' AND T.unittype = 'sentence' ORDER BY F.unit")
+        return [v for v, in db.cur.fetchall()]
+
+    def checks(self, db):
+        from rebabel_format.db import RBBLFile
+        seq = RBBLFile('Sequential' + db.path)
+        expected = self.dump(seq)
+        self.assertGreater(len(expected[0]), 0)
+        self.assertEqual(expected, self.dump(db))
+        # block numbering continues across files
+        self.assertEqual([1, 2, 3, 4, 5], self.indices(db))
+
+class StreamingXMLTest(SimpleTest, unittest.TestCase):
+    def commands(self, db_name):
+        run_command('import', {}, infiles=['data/streaming.flextext'],
+                    mode='flextext', db=db_name)
+
+    def checks(self, db):
+        from rebabel_format.query import Query
+        Q = Query.parse_query(db, {
+            'T': {'type': 'interlinear-text'},
+            'P': {'type': 'paragraph', 'ancestor': 'T'},
+            'W': {'type': 'word', 'ancestor': 'P'},
+        }, order=['P', 'W'])
+        results = list(Q.search())
+        self.assertEqual(4, len(results))
+        self.assertEqual(1, len(set(r['T'] for r in results)))
+        self.assertEqual(2, len(set(r['P'] for r in results)))
+
+        # features of units from earlier blocks are still written
+        text = results[0]['T']
+        def value(feature):
+            return db.get_feature_value_by_name(text, feature)
+        self.assertEqual('Two sentences', value('FlexText:en:title'))
+        self.assertEqual('written after the paragraphs',
+                         value('FlexText:en:comment'))
+        self.assertEqual('text-1', value('FlexText:guid'))
+        self.assertEqual(1, len(db.get_children([text], 'language')[text]))
+
+        pos = db.get_feature('word', 'FlexText:en:pos')[0]
+        db.cur.execute('SELECT value, confidence FROM features WHERE feature = ? ORDER BY unit', (pos,))
+        self.assertEqual([('NOUN', 4), ('VERB', 1)], db.cur.fetchall())
+
+class FailedBlockTest(SimpleTest, unittest.TestCase):
+    def import_errors(self, db_name, conflict, **kwargs):
+        if os.path.isfile(db_name):
+            os.remove(db_name)
+        if conflict:
+            from rebabel_format.db import RBBLFile
+            RBBLFile(db_name).create_feature('word', 'UD:FEATS:Number', 'int')
+        run_command('import', {}, infiles=['data/errors.conllu'],
+                    mode='conllu', db=db_name, **kwargs)
+
+    def commands(self, db_name):
+        for conflict in [False, True]:
+            self.import_errors(f'{conflict}{db_name}', conflict)
+        self.import_errors(db_name, False)
+        # the database isn't checked until the blocks are written
+        self.import_errors('Parallel' + db_name, True, workers=2)
+
+    def dump(self, db):
+        db.cur.execute('SELECT id, type FROM units ORDER BY id')
+        units = db.cur.fetchall()
+        db.cur.execute('SELECT parent, child, isprimary FROM relations ORDER BY child, parent')
+        relations = db.cur.fetchall()
+        db.cur.execute('SELECT unit, feature, value FROM features ORDER BY unit, feature')
+        return units, relations, db.cur.fetchall()
+
+    def sentences(self, db):
+        db.cur.execute("SELECT S.value, I.value FROM features S, features I, tiers TS, tiers TI WHERE S.unit = I.unit AND S.feature = TS.id AND I.feature = TI.id AND TS.name = 'UD:sent_id' AND TI.name = 'meta:index' AND TI.unittype = 'sentence' ORDER BY I.value")
+        return db.cur.fetchall()
+
+    def checks(self, db):
+        from rebabel_format.db import RBBLFile
+        self.assertEqual(self.dump(RBBLFile('False' + db.path)), self.dump(db))
+        # a failed block doesn't prevent the following ones
+        # from being written or change their numbering
+        for conflict, expected in [(False, ['a', 'c', 'd']),
+                                   (True, ['a', 'd'])]:
+            rdb = RBBLFile(f'{conflict}{db.path}')
+            self.assertEqual([(s, i) for i, s in enumerate(expected, 1)],
+                             self.sentences(rdb))
+            rdb.cur.execute("SELECT COUNT(*) FROM units WHERE type = 'word'")
+            self.assertEqual(2*len(expected), rdb.cur.fetchone()[0])
+            # features are only created for blocks which are written
+            self.assertEqual(
+                'c' in expected,
+                rdb.get_feature('word', 'UD:FEATS:Gender')[1] is not None)
+        parallel = RBBLFile('Parallel' + db.path)
+        self.assertEqual([('a', 1), ('d', 2)], self.sentences(parallel))
+        parallel.cur.execute("SELECT COUNT(*) FROM units WHERE type = 'word'")
+        self.assertEqual(4, parallel.cur.fetchone()[0])
+        self.assertIsNone(parallel.get_feature('word', 'UD:FEATS:Gender')[1])
@@ -1,12 +1,79 @@
 #!/usr/bin/env python3
 
 from rebabel_format.parameters import Parameter, process_parameters
-from rebabel_format.query import search
+from rebabel_format.query import Query, search
+
+class MatchTable:
+    '''The results of a query, stored in the temporary table
+    `temp.matches` with one column per unit, so that transformations
+    can be applied to all of them with a few SQL statements.'''
+
+    def __init__(self, db, query):
+        self.db = db
+        self.query = query
+        sql, params = query.compile()
+        self.db.cur.execute('DROP TABLE IF EXISTS temp.matches')
+        self.db.cur.execute(f'CREATE TEMP TABLE matches AS {sql}', params)
+
+    def drop(self):
+        self.db.cur.execute('DROP TABLE IF EXISTS temp.matches')
+        self.db.cur.execute('DROP TABLE IF EXISTS temp.new_values')
+
+    def column(self, name):
+        if name not in self.query.name2unit:
+            raise ValueError(f'No such unit {name}.')
+        return f'U{self.query.name2unit[name].index}'
+
+    def types(self, name):
+        '''Return the unit types which actually occur in column `name`.'''
+        col = self.column(name)
+        self.db.cur.execute(f'SELECT DISTINCT units.type FROM temp.matches M JOIN units ON units.id = M.{col}')
+        return sorted(x[0] for x in self.db.cur.fetchall())
+
+    def units_of_type(self, name, unittype):
+        '''Return SQL and parameters selecting the units in column
+        `name` with type `unittype`.'''
+        col = self.column(name)
+        return f'SELECT M.{col} FROM temp.matches M JOIN units ON units.id = M.{col} WHERE units.type = ?', [unittype]
+
+    def set_values(self, sql, params):
+        '''Fill `temp.new_values` with the `(unit, value)` pairs
+        selected by `sql`. If a unit appears more than once, the last
+        value is kept, as would happen when applying a transformation
+        to each match in sequence.'''
+        self.db.cur.execute('DROP TABLE IF EXISTS temp.new_values')
+        self.db.cur.execute('CREATE TEMP TABLE new_values(unit INTEGER PRIMARY KEY, value)')
+        self.db.cur.execute(f'INSERT OR REPLACE INTO temp.new_values(unit, value) {sql}', params)
+
+    def write_values(self, feature, check, user, confidence):
+        '''Set `feature` to the values in `temp.new_values`.
+        `check(valuetype)` is called for each tier that will be
+        written to and should raise an error if it has the wrong type.'''
+        self.db.cur.execute('SELECT DISTINCT units.type FROM temp.new_values N JOIN units ON units.id = N.unit')
+        for (unittype,) in self.db.cur.fetchall():
+            fid, typ = self.db.get_feature(unittype, feature, error=True)
+            check(typ)
+            units = 'SELECT N.unit FROM temp.new_values N JOIN units ON units.id = N.unit WHERE units.type = ?'
+            info = [user, confidence, self.db.now()]
+            self.db.cur.execute(
+                f'UPDATE features SET value = (SELECT N.value FROM temp.new_values N WHERE N.unit = features.unit), user = ?, confidence = ?, date = ? WHERE feature = ? AND unit IN ({units})',
+                info + [fid, unittype])
+            self.db.cur.execute(
+                f'INSERT OR IGNORE INTO features(unit, feature, value, user, confidence, date) SELECT N.unit, ?, N.value, ?, ?, ? FROM temp.new_values N JOIN units ON units.id = N.unit WHERE units.type = ?',
+                [fid] + info + [unittype])
+        self.db.cur.execute('SELECT unit FROM temp.new_values')
+        units = [u for (u,) in self.db.cur.fetchall()]
+        if feature == 'meta:active':
+            self.db.sync_active(units)
+        self.db.touch_units(units)
 
 class Transformation:
     name = None
     parameters = {}
 
+    # whether apply_sql() is implemented
+    set_based = False
+
     ALL = {}
 
     def __init__(self, conf=None, **kwargs):
@@ -23,6 +90,11 @@ class Transformation:
     def apply(self, db, match_dict):
         pass
 
+    def apply_sql(self, db, matches):
+        '''Apply this transformation to every row of `matches`
+        (a `MatchTable`) at once.'''
+        raise NotImplementedError
+
 class CreateFeature(Transformation):
     name = 'create_feature'
 
@@ -44,6 +116,11 @@ class CreateFeature(Transformation):
             db.create_feature(self.unit_type, self.feature, self.value_type)
             self.done = True
 
+    set_based = True
+
+    def apply_sql(self, db, matches):
+        self.apply(db, {})
+
 class SetFeature(Transformation):
     name = 'set_feature'
 
@@ -59,6 +136,16 @@ class SetFeature(Transformation):
         db.set_feature(match_dict[self.target], self.feature, self.value,
                        user=self.username, confidence=self.confidence)
 
+    set_based = True
+
+    def apply_sql(self, db, matches):
+        col = matches.column(self.target)
+        matches.set_values(f'SELECT M.{col}, ? FROM temp.matches M',
+                           [self.value])
+        matches.write_values(self.feature,
+                             lambda typ: db.check_type(typ, self.value),
+                             self.username, self.confidence)
+
 class SetRefFeature(SetFeature):
     name = 'set_ref_feature'
 
@@ -72,6 +159,14 @@ class SetRefFeature(SetFeature):
         db.set_feature(match_dict[self.target], self.feature, match_dict[self.value],
                        user=self.username, confidence=self.confidence)
 
+    def apply_sql(self, db, matches):
+        col = matches.column(self.target)
+        vcol = matches.column(self.value)
+        matches.set_values(
+            f'SELECT M.{col}, M.{vcol} FROM temp.matches M ORDER BY M.rowid', [])
+        matches.write_values(self.feature, lambda typ: db.check_type(typ, 0),
+                             self.username, self.confidence)
+
 class CopyFeature(Transformation):
     name = 'copy_feature'
 
@@ -101,6 +196,43 @@ class CopyFeature(Transformation):
         db.set_feature(match_dict[self.target], self.target_feature, val,
                        user=self.username, confidence=self.confidence)
 
+    set_based = True
+
+    def apply_sql(self, db, matches):
+        col = matches.column(self.target)
+        scol = matches.column(self.source)
+        feats = {}
+        for unittype in matches.types(self.source):
+            fid, typ = db.get_feature(unittype, self.source_feature, error=True)
+            feats[fid] = typ
+        source_types = set(feats.values())
+        if len(source_types) > 1:
+            raise ValueError(f'Feature {self.source_feature} has multiple value types.')
+        qs = ', '.join(['?']*len(feats))
+        missing = db.first(
+            f'SELECT M.{scol} FROM temp.matches M WHERE NOT EXISTS (SELECT NULL FROM features F WHERE F.unit = M.{scol} AND F.feature IN ({qs}))',
+            *feats)
+        if missing is not None:
+            raise ValueError(f'Unit {missing[0]} has no value for {self.source_feature}.')
+        source_type = source_types.pop() if source_types else None
+        expr = 'F.value'
+        params = []
+        if source_type in ['int', 'ref'] and self.add is not None:
+            expr = 'F.value + ?'
+            params.append(self.add)
+        elif source_type == 'str':
+            expr = '? || F.value || ?'
+            params += [self.prepend or '', self.append or '']
+        matches.set_values(
+            f'SELECT M.{col}, {expr} FROM temp.matches M JOIN features F ON F.unit = M.{scol} AND F.feature IN ({qs}) ORDER BY M.rowid',
+            params + list(feats))
+        def check(typ):
+            compatible = [typ] + (['int', 'ref'] if typ in ['int', 'ref'] else [])
+            if source_type is not None and source_type not in compatible:
+                raise ValueError(f'Cannot copy {source_type} feature {self.source_feature} to {typ} feature {self.target_feature}.')
+        matches.write_values(self.target_feature, check, self.username,
+                             self.confidence)
+
 class RemFeature(Transformation):
     name = 'remove_feature'
 
@@ -112,6 +244,21 @@ class RemFeature(Transformation):
             raise ValueError(f'No such unit {self.target}.')
         db.rem_feature(match_dict[self.target], self.feature)
 
+    set_based = True
+
+    def apply_sql(self, db, matches):
+        for unittype in matches.types(self.target):
+            fid, typ = db.get_feature(unittype, self.feature, error=True)
+            units, params = matches.units_of_type(self.target, unittype)
+            db.cur.execute(
+                f'DELETE FROM features WHERE feature = ? AND unit IN ({units})',
+                [fid] + params)
+            db.cur.execute(units, params)
+            unitids = [u for (u,) in db.cur.fetchall()]
+            if self.feature == 'meta:active':
+                db.sync_active(unitids)
+            db.touch_units(unitids)
+
 class CreateUnit(Transformation):
     name = 'create_unit'
 
@@ -171,12 +318,38 @@ class RemRelation(EditRelation):
     adding = False
     primary = False
 
-def apply_transformations(db, query, commands):
-    for match_dict in search(db, query):
+def apply_transformations(db, query, commands, since=None):
+    for match_dict in search(db, query, prefetch_types=True, stream=True,
+                             snapshot=True, since=since):
         for cmd in commands:
             cmd.apply(db, match_dict)
 
-def transform(db, transformations, username='user', confidence=1):
+def apply_transformations_sql(db, query, commands, since=None):
+    '''Apply `commands` to all matches of `query` at once, if they
+    support it. Return whether this was possible.
+
+    Each command is applied to every match before moving on to the next
+    command, so a command which reads a feature that an earlier command
+    wrote for a different match may see a different value than it would
+    in `apply_transformations`.'''
+    if not all(cmd.set_based for cmd in commands):
+        return False
+    Q = Query.parse_query(db, query)
+    if Q.subqueries:
+        return False
+    if since is not None:
+        Q.changed_since(since)
+    with db.transaction():
+        matches = MatchTable(db, Q)
+        try:
+            for cmd in commands:
+                cmd.apply_sql(db, matches)
+        finally:
+            matches.drop()
+    return True
+
+def transform(db, transformations, username='user', confidence=1,
+              set_based=False, since=None):
     trans = []
     for i, cmd in enumerate(transformations['commands'], 1):
         if 'type' not in cmd:
@@ -188,4 +361,7 @@ def transform(db, transformations, username='user', confidence=1):
             trans.append(cls(cmd, username=username, confidence=confidence))
         except:
             raise ValueError(f'Command {i} has invalid arguments.')
-    apply_transformations(db, transformations['query'], trans)
+    if set_based and apply_transformations_sql(db, transformations['query'],
+                                               trans, since=since):
+        return
+    apply_transformations(db, transformations['query'], trans, since=since)